@@ -0,0 +1,497 @@
+import argparse
+import io
+import json
+import math
+import multiprocessing
+import os
+import sys
+import tarfile
+import time
+import zipfile
+import numpy as np
+import PIL.Image as Image
+from PIL import ImageColor
+import generate_dataset
+from generate_dataset import COLORS, TEXTURES, SHAPES, SPLITS
+
+
+# How many images each task decodes and checks
+AUDIT_CHUNK = 256
+
+# How many tasks the pool works on ahead of the files or archives being read
+AUDIT_PREFETCH = 8
+
+# A pixel is part of the shape if the mean of its channels is darker than this. Well clear of the ringing jpg
+# leaves in the white background, which can pull a single channel a long way down
+FOREGROUND_THRESHOLD = 200
+
+# An image is blank if none of its pixels has a channel darker than this. Anything a shape touches, however faintly
+# after being shrunk for --image-sizes, is darker, while jpg never pulls a white background more than a few levels
+# down
+BLANK_THRESHOLD = 245
+
+# A shape is cut off by the edge of the image if a pixel along the edge is darker than this. Shapes that only
+# come near the edge leave paler, partly covered pixels there, especially once downsampled for --image-sizes
+CLIPPED_THRESHOLD = 128
+
+# Shapes whose mean color has less than this between its largest and smallest channel are taken to be black
+# (which stays exactly gray, even in jpg). The rest are matched to the color they point the same way as, since jpg
+# and antialiasing wash small shapes out a long way towards gray
+BLACK_CHROMA = 2
+
+# The foreground area distributions are histograms of this many equal bins between 0 and 1
+AREA_BINS = 20
+
+# How far (in standard deviations) a realized color or texture fraction may be from the expected one
+STATISTICS_TOLERANCE = 4.0
+
+# The colors as RGB, for checking each shape is drawn in the color its name says
+COLOR_VALUES = np.array([ImageColor.getrgb(color) for color in COLORS], dtype=np.float64)
+
+
+def color_directions(values):
+    """
+    :param values: Array of RGB colors, shape (N, 3)
+    :return: The colors with their gray part taken away, scaled to unit length (zero for grays)
+    """
+    chroma = values - values.min(axis=1)[:, np.newaxis]
+    return chroma / np.maximum(np.sqrt((chroma ** 2).sum(axis=1)), 1e-9)[:, np.newaxis]
+
+
+COLOR_DIRECTIONS = color_directions(COLOR_VALUES)
+
+IMAGE_EXTENSIONS = (".png", ".jpg")
+
+
+class Audit(object):
+    """
+    Everything the auditor learns about a set of images: per shape color, texture and split counts, mean images
+    and foreground area histograms, plus any images that look wrong. Audits of different images can be merged, so
+    each worker keeps its own and hands it back
+    """
+
+    def __init__(self, image_size=None, max_anomalies=100):
+        """
+        :param image_size: The width and height every image should be. Taken from the first image if None
+        :param max_anomalies: How many problem images to keep the names of. All of them are counted
+        """
+        self.image_size = image_size
+        self.max_anomalies = max_anomalies
+        self.images = 0
+        self.colors = np.zeros((len(SHAPES), len(COLORS)), dtype=np.int64)
+        self.textures = np.zeros((len(SHAPES), len(TEXTURES)), dtype=np.int64)
+        self.splits = np.zeros((len(SHAPES), len(SPLITS)), dtype=np.int64)
+        # How many images of each shape went into the pixel statistics, which leaves out any that could not be read
+        # or are the wrong size
+        self.checked = np.zeros(len(SHAPES), dtype=np.int64)
+        self.sums = dict()
+        self.area_histograms = np.zeros((len(SHAPES), AREA_BINS), dtype=np.int64)
+        self.area_totals = np.zeros(len(SHAPES))
+        self.area_min = np.ones(len(SHAPES))
+        self.area_max = np.zeros(len(SHAPES))
+        self.anomalies = []
+        self.anomaly_counts = dict()
+
+    def flag(self, name, problem):
+        """
+        Records an image that looks wrong
+        :param name: Where the image is
+        :param problem: What is wrong with it
+        """
+        self.anomaly_counts[problem] = self.anomaly_counts.get(problem, 0) + 1
+        if len(self.anomalies) < self.max_anomalies:
+            self.anomalies.append({"image": name, "problem": problem})
+
+    def count(self, labels):
+        """
+        Adds images to the color, texture and split counts
+        :param labels: int array of shape (N, 4), the shape, color, texture and split of each image
+        """
+        np.add.at(self.colors, (labels[:, 0], labels[:, 1]), 1)
+        np.add.at(self.textures, (labels[:, 0], labels[:, 2]), 1)
+        np.add.at(self.splits, (labels[:, 0], labels[:, 3]), 1)
+
+    def add(self, names, images, labels):
+        """
+        Checks a batch of images and adds them to the statistics
+        :param names: Where each image is
+        :param images: uint8 array of shape (N, size, size, 3)
+        :param labels: int array of shape (N, 4), the shape, color, texture and split of each image
+        """
+        self.count(labels)
+        if self.image_size is None:
+            self.image_size = images.shape[1]
+        if images.shape[1:] != (self.image_size, self.image_size, 3):
+            for name in names:
+                self.flag(name, "wrong size")
+            return
+        self.images += len(names)
+
+        # Adding the channels one by one is many times faster than images.sum(axis=3) over such a short axis
+        foreground = (images[..., 0].astype(np.uint16) + images[..., 1] + images[..., 2]) < 3 * FOREGROUND_THRESHOLD
+        pixels = foreground.sum(axis=(1, 2))
+        # Kept apart from the foreground, which is for measuring area. A small shape shrunk far enough can cover
+        # no foreground pixels at all and still be plainly there
+        blank = images.reshape(len(names), -1).min(axis=1) >= BLANK_THRESHOLD
+        area = pixels / float(self.image_size * self.image_size)
+        # Nothing of a shape that was drawn properly is ever cut off by the edge of the image
+        clipped = np.zeros(len(names), dtype=bool)
+        for edge in [images[:, 0], images[:, -1], images[:, :, 0], images[:, :, -1]]:
+            clipped |= (edge.astype(np.uint16).sum(axis=2) < 3 * CLIPPED_THRESHOLD).any(axis=1)
+        # The average color of the shape should be the color it is labelled with
+        # One small matrix product per image, rather than masking a copy of the whole batch
+        mean_colors = np.array([np.dot(mask.ravel().astype(np.float32), image.reshape(-1, 3).astype(np.float32))
+                                for mask, image in zip(foreground, images)]) / np.maximum(pixels, 1)[:, np.newaxis]
+        nearest = np.dot(color_directions(mean_colors), COLOR_DIRECTIONS.T).argmax(axis=1)
+        nearest[mean_colors.max(axis=1) - mean_colors.min(axis=1) < BLACK_CHROMA] = COLORS.index("black")
+
+        for shape in range(len(SHAPES)):
+            rows = labels[:, 0] == shape
+            if not rows.any():
+                continue
+            self.checked[shape] += rows.sum()
+            if shape not in self.sums:
+                self.sums[shape] = np.zeros((self.image_size, self.image_size, 3))
+            self.sums[shape] += images[rows].sum(axis=0, dtype=np.uint32)
+            np.add.at(self.area_histograms[shape], np.minimum((area[rows] * AREA_BINS).astype(int), AREA_BINS - 1),
+                      1)
+            self.area_totals[shape] += area[rows].sum()
+            self.area_min[shape] = min(self.area_min[shape], area[rows].min())
+            self.area_max[shape] = max(self.area_max[shape], area[rows].max())
+
+        for index, name in enumerate(names):
+            if blank[index]:
+                self.flag(name, "blank")
+                continue
+            if clipped[index]:
+                self.flag(name, "clipped")
+            # Too faint to tell the color of
+            if pixels[index] > 0 and nearest[index] != labels[index, 1]:
+                self.flag(name, "wrong color")
+
+    def merge(self, other):
+        """
+        Adds in the statistics of another audit of different images
+        """
+        if self.image_size is None:
+            self.image_size = other.image_size
+        self.images += other.images
+        self.colors += other.colors
+        self.textures += other.textures
+        self.splits += other.splits
+        self.checked += other.checked
+        for shape, total in other.sums.items():
+            if total.shape[0] != self.image_size:
+                continue
+            self.sums[shape] = self.sums.get(shape, 0) + total
+        self.area_histograms += other.area_histograms
+        self.area_totals += other.area_totals
+        self.area_min = np.minimum(self.area_min, other.area_min)
+        self.area_max = np.maximum(self.area_max, other.area_max)
+        for problem, count in other.anomaly_counts.items():
+            self.anomaly_counts[problem] = self.anomaly_counts.get(problem, 0) + count
+        self.anomalies += other.anomalies[:self.max_anomalies - len(self.anomalies)]
+
+    def mean_images(self):
+        """
+        :return: Dict of shape name to its mean image, as an Image object
+        """
+        return dict((SHAPES[shape], Image.fromarray(np.round(total / self.checked[shape]).astype(np.uint8)))
+                    for shape, total in self.sums.items())
+
+    def report(self, manifest=None):
+        """
+        :param manifest: The dataset's manifest, to compare the statistics against what was asked for
+        :return: Dict of everything found, ready to be dumped as JSON
+        """
+        shapes = dict()
+        deviations = []
+        requested = dict()
+        if manifest is not None:
+            requested = dict((stats["shape"], stats) for stats in manifest["shapes"])
+        for shape, name in enumerate(SHAPES):
+            count = int(self.colors[shape].sum())
+            stats = requested.get(name)
+            if count == 0 and not (stats and stats["count"]):
+                continue
+            entry = {"count": count,
+                     "color": dict(zip(COLORS, self.colors[shape].tolist())),
+                     "texture": dict(zip(TEXTURES, self.textures[shape].tolist())),
+                     "split": dict(zip(SPLITS, self.splits[shape].tolist())),
+                     "foreground_area": {"mean": self.area_totals[shape] / max(self.checked[shape], 1),
+                                         "min": self.area_min[shape] if self.checked[shape] else None,
+                                         "max": self.area_max[shape] if self.checked[shape] else None,
+                                         "histogram": self.area_histograms[shape].tolist()}}
+            if stats is not None and count != (stats["count"] or 0):
+                deviations.append("{}: expected {} images, found {}".format(name, stats["count"] or 0, count))
+            # Shapes without images or without statistics have no fractions to check
+            if stats is not None and count and None not in stats.values():
+                for attribute, choices, counts in (("color", COLORS, self.colors[shape]),
+                                                   ("texture", TEXTURES, self.textures[shape])):
+                    percent = stats["percent_" + attribute]
+                    expected = percent + (1 - percent) / float(len(choices))
+                    realized = counts[choices.index(stats[attribute])] / float(max(count, 1))
+                    entry[attribute + "_expected_fraction"] = expected
+                    entry[attribute + "_realized_fraction"] = realized
+                    # Binomial spread of the realized fraction
+                    spread = math.sqrt(expected * (1 - expected) / max(count, 1))
+                    if abs(realized - expected) > STATISTICS_TOLERANCE * spread + 1e-9:
+                        deviations.append("{} {} {}: expected {:.3f}, got {:.3f}".format(
+                            name, attribute, stats[attribute], expected, realized))
+            shapes[name] = entry
+        return {"images": self.images,
+                "image_size": self.image_size,
+                "shapes": shapes,
+                "deviations": deviations,
+                "anomaly_counts": self.anomaly_counts,
+                "anomalies": self.anomalies}
+
+
+def parse_name(name):
+    """
+    Works out the labels of an image from where it is, e.g. training/square/square_0012_blue_striped.png
+    :param name: Path of the image, in a directory or an archive
+    :return: List of the shape, color, texture and split indices, None if the name is not one of ours
+    """
+    parts = name.replace("\\", "/").split("/")
+    fields = os.path.splitext(parts[-1])[0].split("_")
+    if len(fields) != 4 or fields[0] not in SHAPES or fields[2] not in COLORS or fields[3] not in TEXTURES:
+        return None
+    # Datasets from before the validation split was planned have no split folders
+    split = SPLITS.index("validation") if "validation" in parts[:-1] else SPLITS.index("training")
+    return [SHAPES.index(fields[0]), COLORS.index(fields[2]), TEXTURES.index(fields[3]), split]
+
+
+def wanted(name):
+    """
+    :return: Whether an archive member or file is an image worth auditing. Skips the ._ files macOS leaves in
+             archives
+    """
+    base = os.path.basename(name)
+    return base.lower().endswith(IMAGE_EXTENSIONS) and not base.startswith("._")
+
+
+def init_audit(image_size, max_anomalies):
+    """
+    Sets up the settings each worker audits with
+    """
+    global AUDIT_SETTINGS
+    AUDIT_SETTINGS = (image_size, max_anomalies)
+
+
+# Set by init_audit
+AUDIT_SETTINGS = (None, 100)
+
+
+def audit_chunk(task):
+    """
+    Decodes and audits a chunk of images
+    :param task: ("files", [(name, path), ...]), ("bytes", [(name, encoded image), ...]) or
+                 ("shard", name, path, first row, one past the last row, labels of those rows)
+    :return: Audit of the chunk
+    """
+    audit = Audit(*AUDIT_SETTINGS)
+    if task[0] == "shard":
+        _, name, path, start, stop, labels = task
+        images = np.load(path, mmap_mode="r")[start:stop]
+        audit.add(["{}[{}]".format(name, row) for row in range(start, stop)], np.asarray(images), labels)
+        return audit
+
+    kind, items = task
+    # Grouped by size so each group can be checked as one array
+    groups = dict()
+    for name, item in items:
+        labels = parse_name(name)
+        if labels is None:
+            audit.flag(name, "unrecognised name")
+            continue
+        try:
+            image = Image.open(item if kind == "files" else io.BytesIO(item))
+            array = np.asarray(image.convert("RGB"))
+        except Exception:
+            audit.flag(name, "unreadable")
+            # Still counted, so it only shows up once, here, and not as missing from the statistics too
+            audit.count(np.array([labels]))
+            continue
+        group = groups.setdefault(array.shape, ([], [], []))
+        group[0].append(name)
+        group[1].append(array)
+        group[2].append(labels)
+    for names, arrays, labels in groups.values():
+        audit.add(names, np.stack(arrays), np.array(labels))
+    return audit
+
+
+def chunks(items):
+    """
+    :return: Generator of lists of up to AUDIT_CHUNK of the items
+    """
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) == AUDIT_CHUNK:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def walk_images(root):
+    """
+    :return: Generator of (name relative to root, path) of every image under root, in a fixed order
+    """
+    for folder, folders, names in os.walk(root):
+        folders.sort()
+        for name in sorted(names):
+            if wanted(name):
+                path = os.path.join(folder, name)
+                yield os.path.relpath(path, root), path
+
+
+def read_archive(path):
+    """
+    Streams the images out of a tar, tar.gz or zip archive without extracting it
+    :return: Generator of (name in the archive, encoded image)
+    """
+    if path.endswith(".zip"):
+        with zipfile.ZipFile(path) as archive:
+            for info in archive.infolist():
+                if wanted(info.filename):
+                    yield info.filename, archive.read(info)
+        return
+    # r| reads the archive front to back, so nothing has to be held in memory or seeked over
+    archive = tarfile.open(path, mode="r|*")
+    try:
+        for member in archive:
+            if member.isfile() and wanted(member.name):
+                yield member.name, archive.extractfile(member).read()
+    finally:
+        archive.close()
+
+
+def audit_tasks(path, manifest, image_size=None):
+    """
+    Works out where the images are and splits them into tasks for audit_chunk
+    :param path: A dataset directory or an archive
+    :param manifest: The dataset's manifest, None if it has none
+    :param image_size: Which size to audit, for datasets made with --image-sizes
+    :return: Generator of tasks
+    """
+    if os.path.isfile(path):
+        for chunk in chunks(read_archive(path)):
+            yield "bytes", chunk
+        return
+
+    if os.path.exists(os.path.join(path, "shards.json")):
+        with open(os.path.join(path, "shards.json")) as fp:
+            shards = json.load(fp)["shards"]
+        labels = np.stack([np.load(os.path.join(path, name + ".npy"))
+                           for name in ["shape", "color", "texture", "split"]], axis=1).astype(np.int64)
+        for shard in shards:
+            for start in range(0, shard["stop"] - shard["start"], AUDIT_CHUNK):
+                stop = min(start + AUDIT_CHUNK, shard["stop"] - shard["start"])
+                yield ("shard", shard["file"], os.path.join(path, shard["file"]), start, stop,
+                       labels[shard["start"] + start:shard["start"] + stop])
+        return
+
+    archives = sorted(name for name in os.listdir(path) if name.endswith((".tar", ".tar.gz", ".tgz", ".zip")))
+    if archives:
+        for name in archives:
+            for chunk in chunks(read_archive(os.path.join(path, name))):
+                yield "bytes", chunk
+        return
+
+    if manifest is not None and manifest.get("image_sizes"):
+        path = os.path.join(path, str(image_size or manifest["image_sizes"][0]))
+    for chunk in chunks(walk_images(path)):
+        yield "files", chunk
+
+
+def run():
+    """
+    Parses the arguments, audits the dataset and writes the report
+    """
+    parser = argparse.ArgumentParser(prog="audit_dataset.py",
+                                     description="Checks a generated dataset: how often each shape came out in each "
+                                                 "color and texture (against its manifest, if it has one), the mean "
+                                                 "image and foreground area of each shape, and any images that are "
+                                                 "blank, clipped by the edge of the image, the wrong color, the wrong "
+                                                 "size or unreadable. Works on dataset directories of image files, "
+                                                 "archives or npy shards, and on single archives. Exits with status "
+                                                 "1 if anything looks wrong.")
+    parser.add_argument("path",
+                        help="Dataset directory (output directory/dataset name) or archive")
+    parser.add_argument("--workers",
+                        help="Number of processes to decode and check images with",
+                        type=int,
+                        default=multiprocessing.cpu_count())
+    parser.add_argument("--image-size",
+                        help="Which size to audit, for datasets made with --image-sizes. Defaults to the largest. "
+                             "Without a manifest, the size every image should be. Defaults to the size of the first",
+                        type=int)
+    parser.add_argument("--output",
+                        help="Where to write the JSON report. Printed if not given")
+    parser.add_argument("--mean-images",
+                        help="Directory to save the mean image of each shape to, as mean_<shape>.png")
+    parser.add_argument("--max-anomalies",
+                        help="How many problem images to list by name. All of them are counted",
+                        type=int,
+                        default=100)
+    args = parser.parse_args()
+
+    if not os.path.exists(args.path):
+        parser.error("{} does not exist".format(args.path))
+    manifest = None
+    if os.path.isdir(args.path):
+        manifest = generate_dataset.load_manifest(args.path)
+    image_size = args.image_size
+    if manifest is not None:
+        sizes = manifest.get("image_sizes") or [manifest["image_size"]]
+        if image_size is not None and image_size not in sizes:
+            parser.error("{} has no images of size {}, only {}".format(args.path, image_size, sizes))
+        image_size = image_size or sizes[0]
+
+    tic = time.time()
+    tasks = audit_tasks(args.path, manifest, image_size)
+    audit = Audit(image_size, args.max_anomalies)
+    init_audit(image_size, args.max_anomalies)
+    pool = None
+    if args.workers > 1:
+        pool = multiprocessing.Pool(args.workers, init_audit, (image_size, args.max_anomalies))
+        results = generate_dataset.run_ahead(pool, audit_chunk, tasks, AUDIT_PREFETCH)
+    else:
+        results = (audit_chunk(task) for task in tasks)
+    try:
+        for result in results:
+            audit.merge(result)
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+    seconds = time.time() - tic
+
+    report = audit.report(manifest)
+    report["path"] = args.path
+    report["seconds"] = seconds
+    report["images_per_sec"] = audit.images / max(seconds, 1e-9)
+    if args.output:
+        with open(args.output, "w") as fp:
+            json.dump(report, fp, indent=2, sort_keys=True)
+    else:
+        print(json.dumps(report, indent=2, sort_keys=True))
+    if args.mean_images:
+        if not os.path.isdir(args.mean_images):
+            os.makedirs(args.mean_images)
+        for shape, image in audit.mean_images().items():
+            image.save(os.path.join(args.mean_images, "mean_{}.png".format(shape)))
+
+    for deviation in report["deviations"]:
+        sys.stderr.write("STATISTICS {}\n".format(deviation))
+    for problem, count in sorted(report["anomaly_counts"].items()):
+        sys.stderr.write("ANOMALY {} images {}\n".format(count, problem))
+    if report["deviations"] or report["anomaly_counts"]:
+        exit(1)
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,240 @@
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import sys
+import tempfile
+import time
+import numpy as np
+import PIL
+import generate_dataset
+
+
+# Output sizes the per shape benchmarks are run at
+SIZES = [64, 128, 256, 512]
+
+# Full runs that get benchmarked, with their image counts scaled down by --workload-scale
+ARGFILES = ["argfiles/dataset_1.txt", "argfiles/dataset_1_big_val.txt"]
+
+# Images rendered before the clock starts, so the caches are in the same state they would be in a long run
+WARMUP_IMAGES = 16
+
+
+def peak_rss_mb():
+    """
+    :return: The most memory this process has had resident at any one time, in MB
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    if sys.platform == "darwin":
+        return peak / (1024.0 * 1024.0)
+    return peak / 1024.0
+
+
+def bench_render(shape, texture, image_size, renderer, min_time, seed):
+    """
+    Renders and png encodes (in memory) images of one shape and texture for at least min_time seconds
+    :param shape: "square" "circle" or "triangle"
+    :param texture: "solid" "striped" or "blank"
+    :param image_size: The width and height of each image
+    :param renderer: "pil" or "numpy"
+    :param min_time: How many seconds to keep going for
+    :param seed: Seed for the plan
+    :return: Dict of results
+    """
+    generate_dataset.init_worker(image_size, generate_dataset.COLORS)
+    batch = generate_dataset.NUMPY_BATCH
+    # Every color shows up, every image gets the texture being benchmarked
+    plan = generate_dataset.plan_shape_set(shape, 0, WARMUP_IMAGES, "red", 0.25, texture, 1.0, seed)
+    list(generate_dataset.render_images(plan, image_size, renderer))
+    render_seconds = 0.0
+    encode_seconds = 0.0
+    images = 0
+    start = WARMUP_IMAGES
+    while render_seconds + encode_seconds < min_time:
+        plan = generate_dataset.plan_shape_set(shape, start, start + batch, "red", 0.25, texture, 1.0, seed)
+        start += batch
+        tic = time.time()
+        rendered = list(generate_dataset.render_images(plan, image_size, renderer))
+        toc = time.time()
+        for image in rendered:
+            generate_dataset.encode_image(image, "png", generate_dataset.DEFAULT_WRITER_OPTIONS)
+        render_seconds += toc - tic
+        encode_seconds += time.time() - toc
+        images += len(plan)
+    return {"images": images,
+            "seconds": render_seconds + encode_seconds,
+            "images_per_sec": images / (render_seconds + encode_seconds),
+            "render_images_per_sec": images / render_seconds}
+
+
+def bench_workload(argfile, scale, renderer, workers, seed):
+    """
+    Runs generate_dataset.py end to end on an argfile with its image counts scaled down, saving into a temporary
+    directory
+    :param argfile: Path to the argfile
+    :param scale: What to multiply the number of each shape by
+    :param renderer: "pil" or "numpy"
+    :param workers: Number of processes to render with
+    :param seed: Seed for the dataset
+    :return: Dict of results
+    """
+    args = generate_dataset.build_parser().parse_args(["@" + argfile])
+    output_directory = tempfile.mkdtemp(prefix="benchmark_")
+    argv = ["@" + argfile, "--output-directory", output_directory, "--dataset-name", "benchmark",
+            "--seed", str(seed), "--renderer", renderer, "--workers", str(workers)]
+    images = 0
+    for shape in generate_dataset.SHAPES:
+        count = max(int(getattr(args, shape + "_number") * scale), 1)
+        argv += ["--{}-number".format(shape), str(count)]
+        images += count
+    try:
+        tic = time.time()
+        generate_dataset.run(argv)
+        seconds = time.time() - tic
+    finally:
+        shutil.rmtree(output_directory)
+    return {"images": images, "seconds": seconds, "images_per_sec": images / seconds}
+
+
+def child(results, function, args):
+    """
+    Runs a benchmark in a fresh process so the peak memory is its own. See in_child
+    """
+    result = function(*args)
+    result["peak_rss_mb"] = peak_rss_mb()
+    results.put(result)
+
+
+def in_child(function, *args):
+    """
+    Runs a benchmark function in its own process
+    :param function: bench_render or bench_workload
+    :param args: Arguments to pass to it
+    :return: Its result, with the peak resident memory of the process added
+    """
+    results = multiprocessing.Queue()
+    process = multiprocessing.Process(target=child, args=(results, function, args))
+    process.start()
+    result = results.get()
+    process.join()
+    return result
+
+
+def compare(results, baseline, threshold):
+    """
+    Finds the benchmarks that got slower or bigger than the baseline by more than the threshold
+    :param results: The "results" of this run
+    :param baseline: The "results" of an earlier run
+    :param threshold: Fraction, e.g. 0.1 flags anything over 10% slower
+    :return: List of messages, one per regression
+    """
+    regressions = []
+    for name in sorted(results):
+        if name not in baseline:
+            continue
+        new = results[name]
+        old = baseline[name]
+        if new["images_per_sec"] < old["images_per_sec"] * (1 - threshold):
+            regressions.append("{}: {:.1f} images/sec, was {:.1f}".format(name, new["images_per_sec"],
+                                                                         old["images_per_sec"]))
+        # A few MB either way is just noise
+        if new["peak_rss_mb"] > old["peak_rss_mb"] * (1 + threshold) + 16:
+            regressions.append("{}: {:.1f}MB peak RSS, was {:.1f}MB".format(name, new["peak_rss_mb"],
+                                                                           old["peak_rss_mb"]))
+    return regressions
+
+
+def run():
+    """
+    Parses the arguments, runs the benchmarks, writes the JSON report and compares it against a baseline
+    """
+    parser = argparse.ArgumentParser(prog="benchmark.py",
+                                     description="Measures how fast (images/sec) and how big (peak RSS) image "
+                                                 "generation is for every shape, texture and image size, and for "
+                                                 "scaled down versions of the argfiles. Writes the results as JSON "
+                                                 "and optionally flags regressions against an earlier run.")
+    parser.add_argument("--sizes",
+                        help="Comma separated image sizes to benchmark each shape and texture at",
+                        default=",".join(str(size) for size in SIZES))
+    parser.add_argument("--renderers",
+                        help="Comma separated renderers to benchmark",
+                        default="pil,numpy")
+    parser.add_argument("--min-time",
+                        help="Seconds to spend on each shape, texture and size",
+                        type=float,
+                        default=0.5)
+    parser.add_argument("--workload-scale",
+                        help="What to multiply the image counts in the argfiles by. 0 skips them",
+                        type=float,
+                        default=0.05)
+    parser.add_argument("--workers",
+                        help="Number of processes the argfile runs render with",
+                        type=int,
+                        default=1)
+    parser.add_argument("--seed",
+                        help="Seed for everything that gets generated",
+                        type=int,
+                        default=0)
+    parser.add_argument("--output",
+                        help="Where to write the JSON results. Printed if not given")
+    parser.add_argument("--baseline",
+                        help="JSON results of an earlier run to compare against")
+    parser.add_argument("--threshold",
+                        help="How much slower (or bigger) than the baseline counts as a regression, e.g. 0.1 for 10%%",
+                        type=float,
+                        default=0.15)
+    args = parser.parse_args()
+
+    # The argfiles are relative to the repository
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    renderers = args.renderers.split(",")
+    results = dict()
+    for renderer in renderers:
+        for image_size in [int(size) for size in args.sizes.split(",")]:
+            for shape in generate_dataset.SHAPES:
+                for texture in generate_dataset.TEXTURES:
+                    name = "{}/{}/{}/{}".format(renderer, shape, texture, image_size)
+                    results[name] = in_child(bench_render, shape, texture, image_size, renderer, args.min_time,
+                                             args.seed)
+                    sys.stderr.write("{:<32} {:>9.1f} images/sec {:>7.1f}MB\n".format(
+                        name, results[name]["images_per_sec"], results[name]["peak_rss_mb"]))
+        if args.workload_scale > 0:
+            for argfile in ARGFILES:
+                name = "{}/{}".format(renderer, os.path.basename(argfile))
+                results[name] = in_child(bench_workload, argfile, args.workload_scale, renderer, args.workers,
+                                         args.seed)
+                sys.stderr.write("{:<32} {:>9.1f} images/sec {:>7.1f}MB\n".format(
+                    name, results[name]["images_per_sec"], results[name]["peak_rss_mb"]))
+
+    report = {"environment": {"python": platform.python_version(),
+                              "numpy": np.__version__,
+                              "pillow": getattr(PIL, "__version__", getattr(PIL, "PILLOW_VERSION", None)),
+                              "platform": platform.platform(),
+                              "cpus": multiprocessing.cpu_count()},
+              "settings": {"min_time": args.min_time,
+                           "workload_scale": args.workload_scale,
+                           "workers": args.workers,
+                           "seed": args.seed},
+              "results": results}
+    if args.output:
+        with open(args.output, "w") as fp:
+            json.dump(report, fp, indent=2, sort_keys=True)
+    else:
+        print(json.dumps(report, indent=2, sort_keys=True))
+
+    if args.baseline:
+        with open(args.baseline) as fp:
+            baseline = json.load(fp)
+        regressions = compare(results, baseline["results"], args.threshold)
+        for regression in regressions:
+            sys.stderr.write("REGRESSION {}\n".format(regression))
+        if regressions:
+            exit(1)
+
+
+if __name__ == "__main__":
+    run()
@@ -1,13 +1,78 @@
 import argparse
+import collections
+import csv
+import gzip
+import io
+import json
+import math
+import multiprocessing
 import numpy as np
 import PIL.Image as Image
+from PIL import ImageColor
 from PIL import ImageDraw
 import random
 import os
+import tarfile
+import threading
+import time
+import zipfile
 
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 
-# A kind of global variable so we only need to generate as many stripe textures as there are colors
+
+# Best clock available for timing stages
+clock = getattr(time, "perf_counter", time.time)
+
+# A kind of global variable so we only need to generate as many stripe textures as there are colors (per image size)
 STRIPES = dict()
+# Fixed orderings so that a seed always maps to the same colors, textures and shapes
+COLORS = ["red", "green", "blue", "black"]
+TEXTURES = ["striped", "solid", "blank"]
+SHAPES = ["square", "circle", "triangle"]
+SPLITS = ["training", "validation"]
+
+# --random-stats picks prototype percents in this range, and this many images of a shape if the number is not given
+RANDOM_PERCENT_RANGE = (0.5, 1.0)
+RANDOM_STATS_NUMBER = 1000
+
+# How many images a worker renders per task. Small enough to keep every core busy until the end of a shape
+CHUNK_SIZE = 100
+
+# Pixels trimmed off the (left/top, right/bottom) edges of each shrunk drawing so no edge artifacts survive
+CIRCLE_INSET = (1, 0)
+POLYGON_INSET = (2, 1)
+
+# How many images the NumPy renderer works on at once. Bounds the size of its intermediate arrays
+NUMPY_BATCH = 32
+
+# How many images go in each array file of --format npy-shards
+SHARD_SIZE = 1024
+
+# How many images share a seed when planning. Changing this changes every dataset
+PLAN_BLOCK = 1024
+
+# How --image-sizes shrinks the images. BOX averages every pixel it covers, ANTIALIAS is the closest older Pillow has
+RESIZE_FILTER = getattr(Image, "BOX", None) or Image.ANTIALIAS
+
+# How many encoding tasks the pool works on ahead of the archive being written
+ARCHIVE_PREFETCH = 8
+
+# Where the seed, the statistics and the progress of a dataset are kept, inside the dataset directory
+MANIFEST_FILE = "manifest.json"
+
+# One row of the plan holds every random choice made for an image
+PLAN_DTYPE = np.dtype([("shape", np.int8),
+                       ("index", np.int64),
+                       ("color", np.int8),
+                       ("texture", np.int8),
+                       ("angle", np.int16),
+                       ("scale", np.float64),
+                       ("shift_x", np.float64),
+                       ("shift_y", np.float64),
+                       ("split", np.int8)])
 
 
 def percentage_float(x):
@@ -22,6 +87,33 @@ def percentage_float(x):
     return x
 
 
+def positive_int(x):
+    """
+    Converts a string to an int and requires it to be at least 1
+    :param x: Something that can be cast to int
+    :return: The converted int
+    """
+    x = int(x)
+    if x < 1:
+        raise argparse.ArgumentTypeError("%r is less than 1" % x)
+    return x
+
+
+def size_list(x):
+    """
+    Converts a comma separated string of image sizes to a list of ints
+    :param x: String like "64,128,256"
+    :return: The sizes, largest first
+    """
+    try:
+        sizes = sorted(set(int(size) for size in x.split(",")), reverse=True)
+    except ValueError:
+        raise argparse.ArgumentTypeError("%r is not a comma separated list of sizes" % x)
+    if sizes[-1] < 1:
+        raise argparse.ArgumentTypeError("%r has a size less than 1" % x)
+    return sizes
+
+
 def random_stats(args):
     """
     Creates reasonable random statistics to generate prototypes. Saves them in the arguments object
@@ -29,82 +121,1235 @@ def random_stats(args):
     :returns: The modified namespace object with values inserted for all of the shape statistics
 
     """
+    # Seeded, so the same seed always picks the same statistics
+    rng = np.random.RandomState([args.seed, 3 * len(SHAPES)])
+    for shape in SHAPES:
+        # Any statistics given are ignored, as --random-stats says
+        setattr(args, shape + "_color", COLORS[rng.randint(len(COLORS))])
+        setattr(args, shape + "_percent_color", round(rng.uniform(*RANDOM_PERCENT_RANGE), 2))
+        setattr(args, shape + "_texture", TEXTURES[rng.randint(len(TEXTURES))])
+        setattr(args, shape + "_percent_texture", round(rng.uniform(*RANDOM_PERCENT_RANGE), 2))
+        # The number of images is up to the user, if they gave one
+        if getattr(args, shape + "_number") is None:
+            setattr(args, shape + "_number", RANDOM_STATS_NUMBER)
     return args
 
 
-def create_shape_set(shape, filetype, count, prototype_color, percent_color, prototype_texture, percent_texture,
-                     color_choices, texture_choices, image_size, validation_set, traindir, valdir):
+def build_stripes(image_size, color_choices):
     """
-    Creates and saves a set of shapes
-    :param shape: The shape to generate
-    :param filetype: Either png or jpg
-    :param count: The number of images to generate
+    Creates the stripe images twice the size of the output so we can rotate them without issue
+    :param image_size: The width and height of each output image
+    :param color_choices: List of possible colors
+    """
+    for color in color_choices:
+        STRIPES[color, image_size] = Image.new("RGB", (image_size * 2, image_size * 2), "white")
+        stripes = ImageDraw.Draw(STRIPES[color, image_size])
+        for y in range(0, image_size * 2, 20):
+            stripes.line([(0, y), (image_size * 2, y)], fill=color, width=3)
+        del stripes
+
+
+def rotate_stripes(color, angle, image_size):
+    """
+    Rotates the stripe image and crops it down to the output size
+    :param color: "red" "green" "blue" or "black"
+    :param angle: How far to rotate the stripes, in degrees
+    :param image_size: The width and height of each output image
+    :return: Image object the size of the output
+    """
+    stripes_size = image_size * 2
+    if (color, image_size) not in STRIPES:
+        build_stripes(image_size, [color])
+    tmpimg = STRIPES[color, image_size].rotate(angle)
+    # Make sure we are centered on the image so we don't get any of the rotation artifacts
+    return tmpimg.crop((stripes_size // 4, stripes_size // 4,
+                        stripes_size - stripes_size // 4, stripes_size - stripes_size // 4))
+
+
+class StripeCache(object):
+    """
+    Keeps rotated and cropped stripe images around so each (color, angle, image size) only gets rotated once.
+    When the cache goes over its memory budget the least recently used stripe images are thrown away
+    """
+
+    def __init__(self, budget_bytes):
+        """
+        :param budget_bytes: Roughly how much memory the cached images may take up
+        """
+        self.budget_bytes = budget_bytes
+        self.used_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.tiles = collections.OrderedDict()
+
+    def get(self, color, angle, image_size):
+        """
+        :param color: "red" "green" "blue" or "black"
+        :param angle: How far to rotate the stripes, in degrees
+        :param image_size: The width and height of each output image
+        :return: The stripe image rotated by the angle and cropped down to the output size. Do not draw on it
+        """
+        key = (color, int(angle), image_size)
+        tile = self.tiles.pop(key, None)
+        if tile is None:
+            self.misses += 1
+            tile = rotate_stripes(color, angle, image_size)
+            self.used_bytes += tile_bytes(tile)
+        else:
+            self.hits += 1
+        # Put it back at the most recently used end
+        self.tiles[key] = tile
+        while self.used_bytes > self.budget_bytes and len(self.tiles) > 1:
+            _, evicted = self.tiles.popitem(last=False)
+            self.used_bytes -= tile_bytes(evicted)
+        return tile
+
+    def prewarm(self, color_choices, image_size):
+        """
+        Rotates every stripe image up front, as far as the budget allows
+        :param color_choices: List of possible colors
+        :param image_size: The width and height of each output image
+        """
+        for color in color_choices:
+            for angle in range(0, 181):
+                if self.used_bytes + image_size * image_size * 3 > self.budget_bytes:
+                    return
+                self.get(color, angle, image_size)
+
+    def resize(self, budget_bytes):
+        """
+        Changes the memory budget, throwing away stripe images if it shrank
+        :param budget_bytes: Roughly how much memory the cached images may take up
+        """
+        self.budget_bytes = budget_bytes
+        while self.used_bytes > self.budget_bytes and self.tiles:
+            _, evicted = self.tiles.popitem(last=False)
+            self.used_bytes -= tile_bytes(evicted)
+
+
+# Ditto for the rotated versions of them. run() sets the budget from --stripe-cache-mb
+STRIPE_CACHE = StripeCache(256 * 1024 * 1024)
+
+
+def tile_bytes(image):
+    """
+    :return: Roughly how many bytes the pixels of an RGB image take up
+    """
+    return image.size[0] * image.size[1] * 3
+
+
+class Profiler(object):
+    """
+    Collects how long each stage of making an image takes, as a count, a total and a histogram with power of two
+    microsecond buckets, plus a few counters and how many images were finished in each second of the run. Safe to
+    use from the writer threads
+    """
+
+    BUCKETS = 32
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = clock()
+        self.stages = dict()
+        self.counters = dict()
+        self.timeline = dict()
+
+    def add(self, stage, seconds):
+        """
+        Records one run of a stage
+        :param stage: Name of the stage
+        :param seconds: How long it took
+        """
+        # Bucket i holds times from 2^(i-1) up to 2^i microseconds
+        bucket = min(int(seconds * 1e6).bit_length(), self.BUCKETS - 1)
+        with self.lock:
+            if stage not in self.stages:
+                self.stages[stage] = [0, 0.0, [0] * self.BUCKETS]
+            entry = self.stages[stage]
+            entry[0] += 1
+            entry[1] += seconds
+            entry[2][bucket] += 1
+
+    def count(self, counter, amount=1):
+        """
+        Adds to a counter, e.g. bytes written
+        """
+        with self.lock:
+            self.counters[counter] = self.counters.get(counter, 0) + amount
+
+    def progress(self, images):
+        """
+        Records that some images were just finished
+        """
+        second = int(clock() - self.started)
+        with self.lock:
+            self.timeline[second] = self.timeline.get(second, 0) + images
+
+    def take(self):
+        """
+        Hands over everything collected so far and starts again from nothing
+        :return: Dict that can be passed to merge, in this process or another
+        """
+        with self.lock:
+            snapshot = {"stages": self.stages, "counters": self.counters}
+            self.stages = dict()
+            self.counters = dict()
+        return snapshot
+
+    def merge(self, snapshot):
+        """
+        Adds in what another profiler collected. See take
+        """
+        with self.lock:
+            for stage, (count, total, histogram) in snapshot["stages"].items():
+                if stage not in self.stages:
+                    self.stages[stage] = [0, 0.0, [0] * self.BUCKETS]
+                entry = self.stages[stage]
+                entry[0] += count
+                entry[1] += total
+                entry[2] = [mine + theirs for mine, theirs in zip(entry[2], histogram)]
+            for counter, amount in snapshot["counters"].items():
+                self.counters[counter] = self.counters.get(counter, 0) + amount
+
+    def report(self):
+        """
+        :return: Dict of everything collected, ready to be dumped as JSON
+        """
+        stages = dict()
+        for stage, (count, total, histogram) in self.stages.items():
+            stages[stage] = {"count": count,
+                             "total_seconds": total,
+                             "mean_microseconds": total * 1e6 / count,
+                             "histogram_microseconds": dict(("<{}".format(2 ** bucket), n)
+                                                            for bucket, n in enumerate(histogram) if n)}
+        seconds = max(clock() - self.started, 1e-9)
+        images = sum(self.timeline.values())
+        return {"seconds": seconds,
+                "images": images,
+                "images_per_sec": images / seconds,
+                "images_per_second_over_time": [self.timeline.get(second, 0)
+                                                for second in range(max(self.timeline or [-1]) + 1)],
+                "stages": stages,
+                "counters": dict(self.counters)}
+
+
+# Collects timings when --profile or --stats-json is given. None otherwise, so checking it is all the hot path
+# pays when profiling is off
+PROFILER = None
+
+
+def take_profile():
+    """
+    :return: Everything this process's profiler collected since the last call (see Profiler.take), None if
+             profiling is off
+    """
+    if PROFILER is None:
+        return None
+    # Hand over the stripe cache's counts along with everything else
+    PROFILER.count("stripe_cache_hits", STRIPE_CACHE.hits)
+    PROFILER.count("stripe_cache_misses", STRIPE_CACHE.misses)
+    STRIPE_CACHE.hits = 0
+    STRIPE_CACHE.misses = 0
+    return PROFILER.take()
+
+
+def init_worker(image_size, color_choices, stripe_cache_bytes=None, profile=False):
+    """
+    Sets up the global state each worker process needs before it can render anything
+    :param image_size: The width and height of each output image
+    :param color_choices: List of possible colors
+    :param stripe_cache_bytes: Memory budget for the rotated stripe cache, None to leave it as is
+    :param profile: Whether to time each stage of making an image. See Profiler
+    """
+    global PROFILER
+    PROFILER = Profiler() if profile else None
+    if (color_choices[0], image_size) not in STRIPES:
+        build_stripes(image_size, color_choices)
+    if stripe_cache_bytes is not None:
+        STRIPE_CACHE.resize(stripe_cache_bytes)
+    TEMPLATE_CACHE.prewarm(color_choices, TEXTURES, image_size)
+
+
+# The statistics of one shape, as given by --<shape>-number, --<shape>-color, --<shape>-percent-color, ...
+ShapeSpec = collections.namedtuple("ShapeSpec", ["shape", "count", "color", "percent_color",
+                                                 "texture", "percent_texture"])
+
+# Everything that decides what a dataset looks like, apart from the seed
+DatasetSpec = collections.namedtuple("DatasetSpec", ["shapes", "image_size", "validation_split"])
+
+
+# How ImageWriter encodes and saves images. See writer_options_from_args for what each one means
+WriterOptions = collections.namedtuple("WriterOptions", ["threads", "queue_size", "fsync", "fsync_every",
+                                                         "palette", "png_compress_level", "png_optimize",
+                                                         "jpeg_quality", "jpeg_subsampling"])
+
+DEFAULT_WRITER_OPTIONS = WriterOptions(threads=2, queue_size=16, fsync="none", fsync_every=64, palette=False,
+                                       png_compress_level=6, png_optimize=False, jpeg_quality=75,
+                                       jpeg_subsampling="4:2:0")
+
+
+def spec_from_args(args):
+    """
+    Pulls the dataset statistics out of the parsed arguments
+    :param args: The namespace object returned by parse_args()
+    :return: DatasetSpec with a ShapeSpec for every shape in SHAPES
+    """
+    shapes = [ShapeSpec(shape, getattr(args, shape + "_number"), getattr(args, shape + "_color"),
+                        getattr(args, shape + "_percent_color"), getattr(args, shape + "_texture"),
+                        getattr(args, shape + "_percent_texture"))
+              for shape in SHAPES]
+    return DatasetSpec(shapes, args.image_size, args.validation_split)
+
+
+def plan_shape_set(shape, start, stop, prototype_color, percent_color, prototype_texture, percent_texture, seed):
+    """
+    Draws the random parameters for images start..stop-1 of a shape all at once. Parameters are drawn in fixed
+    blocks of PLAN_BLOCK images, each with its own seed, so any range of images always gets the same parameters
+    :param shape: The shape to plan
+    :param start: The number of the first image to plan
+    :param stop: One past the number of the last image to plan
     :param prototype_color: The color of the prototypical shape
     :param percent_color: The percent of shapes that are that color
     :param prototype_texture: Ditto
     :param percent_texture: Ditto
-    :param color_choices: List of possible colors
-    :param texture_choices: List of possible textures
+    :param seed: The global seed for the dataset
+    :return: Structured array with PLAN_DTYPE, one row per image
+    """
+    first_block = start // PLAN_BLOCK
+    last_block = (stop + PLAN_BLOCK - 1) // PLAN_BLOCK
+    blocks = []
+    for block in range(first_block, last_block):
+        rng = np.random.RandomState([seed, SHAPES.index(shape), block])
+        rows = np.zeros(PLAN_BLOCK, dtype=PLAN_DTYPE)
+        rows["shape"] = SHAPES.index(shape)
+        rows["index"] = np.arange(block * PLAN_BLOCK, (block + 1) * PLAN_BLOCK)
+        # Prototype color for percent_color of the images, anything (including the prototype) for the rest
+        rows["color"] = np.where(rng.uniform(size=PLAN_BLOCK) < percent_color, COLORS.index(prototype_color),
+                                 rng.randint(len(COLORS), size=PLAN_BLOCK))
+        # Ditto for texture
+        rows["texture"] = np.where(rng.uniform(size=PLAN_BLOCK) < percent_texture,
+                                   TEXTURES.index(prototype_texture), rng.randint(len(TEXTURES), size=PLAN_BLOCK))
+        rows["angle"] = rng.randint(0, 181, size=PLAN_BLOCK)
+        rows["scale"] = rng.uniform(1, 4, size=PLAN_BLOCK)
+        rows["shift_x"] = rng.uniform(size=PLAN_BLOCK)
+        rows["shift_y"] = rng.uniform(size=PLAN_BLOCK)
+        blocks.append(rows)
+    if not blocks:
+        return np.zeros(0, dtype=PLAN_DTYPE)
+    plan = np.concatenate(blocks)
+    return plan[start - first_block * PLAN_BLOCK:stop - first_block * PLAN_BLOCK]
+
+
+def plan_dataset(shape_stats, seed, validation_split=0.0):
+    """
+    Draws the parameters for every image in the dataset and decides which ones go in the validation set
+    :param shape_stats: List of ShapeSpec (or tuples in the same order)
+    :param seed: The global seed for the dataset
+    :param validation_split: The percentage of each shape to put in the validation set
+    :return: Structured array with PLAN_DTYPE, the shapes one after another in the order given
+    """
+    return plan_segments(shape_stats, [(stats[0], 0, stats[1]) for stats in shape_stats], seed, validation_split)
+
+
+def plan_segments(shape_stats, segments, seed, validation_split=0.0):
+    """
+    Plans a dataset that was generated in pieces, e.g. one that has been extended with --extend. Each segment is a
+    range of image numbers of one shape, and gets its own validation split so the images planned before it never
+    change split
+    :param shape_stats: List of ShapeSpec (or tuples in the same order)
+    :param segments: List of (shape, first image number, one past the last image number)
+    :param seed: The global seed for the dataset
+    :param validation_split: The percentage of each segment to put in the validation set
+    :return: Structured array with PLAN_DTYPE, the segments one after another in the order given
+    """
+    stats_by_shape = dict((stats[0], stats) for stats in shape_stats)
+    plans = []
+    for shape, start, stop in segments:
+        _, _, prototype_color, percent_color, prototype_texture, percent_texture = stats_by_shape[shape]
+        plan = plan_shape_set(shape, start, stop, prototype_color, percent_color, prototype_texture,
+                              percent_texture, seed)
+        # Exactly the same share of every shape goes into the validation set. The first segment of each shape keeps
+        # the seed it has always had, so a dataset planned in one go stays the same
+        if start == 0:
+            rng = np.random.RandomState([seed, len(SHAPES) + SHAPES.index(shape)])
+        else:
+            rng = np.random.RandomState([seed, len(SHAPES) + SHAPES.index(shape), start])
+        count = stop - start
+        plan["split"][rng.choice(count, int(count * validation_split), replace=False)] = SPLITS.index("validation")
+        plans.append(plan)
+    if not plans:
+        return np.zeros(0, dtype=PLAN_DTYPE)
+    return np.concatenate(plans)
+
+
+def index_widths(shape_stats, digits=0):
+    """
+    :param shape_stats: List of ShapeSpec, as passed to plan_dataset
+    :param digits: Pad to at least this many digits, see --index-digits
+    :return: List of how many digits the image numbers of each shape in SHAPES get zero padded to
+    """
+    widths = [max(1, digits)] * len(SHAPES)
+    for stats in shape_stats:
+        widths[SHAPES.index(stats[0])] = max(len(str(max(stats[1] - 1, 0))), digits)
+    return widths
+
+
+def segment_widths(widths, segments):
+    """
+    Works out the zero padding of every image number. Images added with --extend keep the padding the dataset was
+    made with while their numbers fit in it. Past that, each segment is padded to the width of its own largest
+    number, so no image that is already saved changes name and none is left unpadded
+    :param widths: The padding the dataset was made with, from index_widths
+    :param segments: List of (shape, first image number, one past the last image number), see plan_segments
+    :return: For each shape in SHAPES, list of (first image number, digits) from that number on, in order
+    """
+    padding = [[(0, width)] for width in widths]
+    for shape, start, stop in segments:
+        steps = padding[SHAPES.index(shape)]
+        digits = len(str(max(stop - 1, 0)))
+        if digits > steps[-1][1]:
+            steps.append((start, digits))
+    return padding
+
+
+def work_units(count, shards=None):
+    """
+    Splits a plan into the pieces that get handed out, round robin, when a dataset is made on several machines with
+    --num-shards. Machine i makes work_units(...)[i::num_shards], so every machine gets a mix of every shape and
+    nothing depends on how many processes each one has
+    :param count: Number of rows in the plan
+    :param shards: The npy shards made by create_shards or the archives laid out by plan_archives, None when saving
+                   image files
+    :return: List of (npy shard or archive file name or None, first plan row, one past the last plan row). Image
+             files are handed out CHUNK_SIZE rows at a time, npy shards and archives whole
+    """
+    if shards is not None:
+        return [tuple(shard) for shard in shards]
+    return [(None, start, min(start + CHUNK_SIZE, count)) for start in range(0, count, CHUNK_SIZE)]
+
+
+def pending_ranges(start, stop, completed):
+    """
+    :param start: First plan row of a range
+    :param stop: One past the last plan row of the range
+    :param completed: Sorted list of non overlapping [start, stop) ranges that are done
+    :return: List of (start, stop) pieces of the range that are not done yet
+    """
+    pending = []
+    for done_start, done_stop in completed:
+        if done_stop <= start:
+            continue
+        if done_start >= stop:
+            break
+        if done_start > start:
+            pending.append((start, done_start))
+        start = max(start, done_stop)
+    if start < stop:
+        pending.append((start, stop))
+    return pending
+
+
+def manifest_finished(manifest):
+    """
+    :param manifest: Dict loaded by load_manifest
+    :return: Whether every image this directory's slice of the dataset (see --shard-index) is meant to hold is saved
+    """
+    count = sum(stop - start for _, start, stop in manifest["segments"])
+    units = work_units(count, manifest.get("shards") or manifest.get("archives"))
+    return not any(pending_ranges(start, stop, manifest["completed"])
+                   for _, start, stop in units[manifest["shard_index"]::manifest["num_shards"]])
+
+
+def add_range(completed, start, stop):
+    """
+    :param completed: Sorted list of non overlapping [start, stop) ranges that are done
+    :param start: First plan row of a range that just got done
+    :param stop: One past its last plan row
+    :return: The new list of done ranges, with touching ranges merged so it stays short
+    """
+    merged = []
+    for done_start, done_stop in completed:
+        if done_stop < start or done_start > stop:
+            merged.append([done_start, done_stop])
+        else:
+            start = min(start, done_start)
+            stop = max(stop, done_stop)
+    merged.append([start, stop])
+    return sorted(merged)
+
+
+def load_manifest(directory):
+    """
+    :param directory: The dataset directory
+    :return: The manifest saved by save_manifest, None if there is none
+    """
+    path = os.path.join(directory, MANIFEST_FILE)
+    if not os.path.exists(path):
+        return None
+    with open(path) as fp:
+        return json.load(fp)
+
+
+def save_manifest(directory, manifest, sync=False):
+    """
+    Saves the manifest so that a crash at any point leaves either the old or the new one behind, never half of one
+    :param directory: The dataset directory
+    :param manifest: Dict of everything needed to plan the dataset again and what is done. See run
+    :param sync: Whether to fsync it to disk before replacing the old one
+    """
+    save_json(os.path.join(directory, MANIFEST_FILE), manifest, sync)
+
+
+def save_json(path, data, sync=False):
+    """
+    Writes a JSON file next to where it goes and then moves it into place, so a crash at any point leaves either
+    the old or the new one behind
+    :param path: Where the file goes
+    :param data: What to save
+    :param sync: Whether to fsync it to disk before replacing the old one
+    """
+    with open(path + ".tmp", "w") as fp:
+        json.dump(data, fp, indent=2, sort_keys=True)
+        if sync:
+            fp.flush()
+            os.fsync(fp.fileno())
+    # os.rename does not replace an existing file on Windows under Python 2
+    getattr(os, "replace", os.rename)(path + ".tmp", path)
+
+
+def create_images(plan, widths, filetype, image_size, directory, pool=None, renderer="pil", output_format="files",
+                  shard_size=SHARD_SIZE, writer_options=DEFAULT_WRITER_OPTIONS, shards=None, completed=(),
+                  checkpoint=None, shard_index=0, num_shards=1, archive=None, archives=None, subfolders=False,
+                  image_sizes=None):
+    """
+    Creates and saves the images in the plan, spreading the work over the pool if there is one. Files go straight
+    into their training or validation directory, npy shards go straight into their slot in the shard
+    :param plan: Rows of the dataset plan
+    :param widths: How many digits to zero pad the image numbers of each shape to. See segment_widths
+    :param filetype: Either png or jpg
+    :param image_size: The width and height of each output image
+    :param directory: The dataset directory
+    :param pool: Optional multiprocessing pool to render the images with
+    :param renderer: "pil" to draw each image with the draw_* functions or "numpy" to use render_batch_numpy
+    :param output_format: "files" for one image file per image or "npy-shards" for arrays. See create_shards
+    :param shard_size: How many images go in each npy shard
+    :param writer_options: WriterOptions for encoding and saving image files
+    :param shards: The npy shards already made by create_shards, None to make them here
+    :param completed: Sorted list of [start, stop) ranges of plan rows that are already saved and can be skipped
+    :param checkpoint: Optional function called with (start, stop) each time a range of plan rows has been saved
+    :param shard_index: Which of the num_shards slices of the dataset to make. See work_units
+    :param num_shards: How many machines the dataset is split between
+    :param archive: "tar" "tar.gz" or "zip" to stream the image files into archives instead of saving them
+    :param archives: Where each range of plan rows goes with archive, see plan_archives. The plan has to be in
+                     archive order, see archive_order
+    :param subfolders: Put each image file in a folder named after its shape, e.g. training/square/
+    :param image_sizes: Sizes to save each image file at, each in its own folder of the dataset directory. The
+                        images are rendered once at image_size and shrunk to the others. None to only save them at
+                        image_size, straight into the dataset directory
+    """
+    if archive is not None:
+        # Archives can't be appended to, so each one is made in one go and checkpointed once it is complete
+        for name, start, stop in work_units(len(plan), archives)[shard_index::num_shards]:
+            if not pending_ranges(start, stop, completed):
+                continue
+            write_archive(plan[start:stop], widths, filetype, image_size, os.path.join(directory, name), archive,
+                          pool, renderer, writer_options, subfolders)
+            if checkpoint is not None:
+                checkpoint(start, stop)
+        return
+
+    if output_format == "npy-shards" and shards is None:
+        shards = create_shards(plan, image_size, directory, shard_size, (), shard_index, num_shards)
+    tasks = []
+    for shard, start, stop in work_units(len(plan), shards)[shard_index::num_shards]:
+        for chunk_start in range(start, stop, CHUNK_SIZE):
+            for todo_start, todo_stop in pending_ranges(chunk_start, min(chunk_start + CHUNK_SIZE, stop), completed):
+                if shard is None:
+                    tasks.append((render_plan, todo_start, todo_stop,
+                                  (plan[todo_start:todo_stop], widths, filetype, image_size, directory, renderer,
+                                   writer_options, subfolders, image_sizes)))
+                else:
+                    tasks.append((render_plan_to_shard, todo_start, todo_stop,
+                                  (plan[todo_start:todo_stop], image_size, renderer,
+                                   os.path.join(directory, shard), todo_start - start)))
+    if pool is None:
+        results = (render_chunk(task) for task in tasks)
+    else:
+        results = pool.imap_unordered(render_chunk, tasks)
+    for start, stop, count, profile in results:
+        if checkpoint is not None:
+            checkpoint(start, stop)
+        if PROFILER is not None:
+            # Workers of a pool shared with other datasets may not be profiling
+            if profile is not None:
+                PROFILER.merge(profile)
+            PROFILER.progress(count)
+
+
+def render_chunk(task):
+    """
+    Runs render_plan or render_plan_to_shard on a range of plan rows and says which range it was, so the caller
+    can checkpoint it however the results come back
+    :param task: Tuple of (render function, first plan row, one past the last plan row, task for the function)
+    :return: Tuple of (first plan row, one past the last plan row, images saved, what the profiler collected)
+    """
+    render, start, stop, render_task = task
+    count, profile = render(render_task)
+    return start, stop, count, profile
+
+
+def render_plan(task):
+    """
+    Renders the images in a slice of the plan and hands them to an ImageWriter to encode and save
+    :param task: Tuple of (plan rows, widths, filetype, image_size, directory, renderer, writer options,
+                 subfolders, image sizes). See create_images
+    :return: The number of images saved and what the profiler collected (see take_profile)
+    """
+    plan, widths, filetype, image_size, directory, renderer, writer_options, subfolders, image_sizes = task
+    writer = ImageWriter(filetype, writer_options)
+    try:
+        for row, image in zip(plan, render_images(plan, image_size, renderer)):
+            name = image_name(row, widths, filetype, subfolders)
+            if image_sizes is None:
+                writer.put(image, "{0}/{1}".format(directory, name))
+                continue
+            # Every size comes from the same render, so they match image for image
+            for size in image_sizes:
+                writer.put(downsample(image, size), "{0}/{1}/{2}".format(directory, size, name))
+    finally:
+        writer.close()
+
+    return len(plan), take_profile()
+
+
+def downsample(image, size):
+    """
+    :param image: Image object
+    :param size: The width and height to shrink it to
+    :return: The image shrunk to size, or the image itself if it is that size already
+    """
+    if image.size[0] == size:
+        return image
+    if PROFILER is not None:
+        tic = clock()
+    image = image.resize((size, size), RESIZE_FILTER)
+    if PROFILER is not None:
+        PROFILER.add("resize", clock() - tic)
+    return image
+
+
+def image_name(row, widths, filetype, subfolders=False):
+    """
+    :param row: Row of the dataset plan
+    :param widths: How many digits to zero pad the image numbers of each shape to. See segment_widths
+    :param filetype: Either png or jpg
+    :param subfolders: Put the image in a folder named after its shape
+    :return: Where the image goes in the dataset, training/shape_number_color_texture.png or
+             training/shape/shape_number_color_texture.png
+    """
+    digits = [width for first, width in widths[row["shape"]] if first <= row["index"]][-1]
+    name = "{0}_{1:0{2}d}_{3}_{4}.{5}".format(SHAPES[row["shape"]], row["index"], digits, COLORS[row["color"]],
+                                              TEXTURES[row["texture"]], filetype)
+    if subfolders:
+        return "{0}/{1}/{2}".format(SPLITS[row["split"]], SHAPES[row["shape"]], name)
+    return "{0}/{1}".format(SPLITS[row["split"]], name)
+
+
+def encode_plan(task):
+    """
+    Renders and encodes the images in a slice of the plan without saving them, for write_archive
+    :param task: Tuple of (plan rows, widths, filetype, image_size, renderer, writer options, subfolders)
+    :return: List of (name in the archive, encoded bytes), one per row, and what the profiler collected
+    """
+    plan, widths, filetype, image_size, renderer, writer_options, subfolders = task
+    members = []
+    for row, image in zip(plan, render_images(plan, image_size, renderer)):
+        if PROFILER is not None:
+            tic = clock()
+        members.append((image_name(row, widths, filetype, subfolders),
+                        encode_image(image, filetype, writer_options)))
+        if PROFILER is not None:
+            PROFILER.add("encode", clock() - tic)
+    return members, take_profile()
+
+
+def writer_options_from_args(args):
+    """
+    Pulls the encoder and writer settings out of the parsed arguments
+    :param args: The namespace object returned by parse_args()
+    :return: WriterOptions
+    """
+    return WriterOptions(threads=args.writer_threads, queue_size=max(args.writer_threads, 1) * 8, fsync=args.fsync,
+                         fsync_every=args.fsync_every, palette=args.palette,
+                         png_compress_level=args.png_compress_level, png_optimize=args.png_optimize,
+                         jpeg_quality=args.jpeg_quality, jpeg_subsampling=args.jpeg_subsampling)
+
+
+def encode_image(image, filetype, options):
+    """
+    Encodes an image the way the writer options say to
+    :param image: Image object
+    :param filetype: Either png or jpg
+    :param options: WriterOptions
+    :return: The encoded file as bytes
+    """
+    buf = io.BytesIO()
+    if filetype == "jpg":
+        image.save(buf, "JPEG", quality=options.jpeg_quality, subsampling=options.jpeg_subsampling)
+    else:
+        if options.palette:
+            # The images only ever hold white and the four colors, so this loses nothing
+            image = image.quantize(palette=palette_image(), dither=0)
+        image.save(buf, "PNG", compress_level=options.png_compress_level, optimize=options.png_optimize)
+    return buf.getvalue()
+
+
+def palette_image():
+    """
+    :return: "P" mode image whose palette is white followed by COLORS, for Image.quantize
+    """
+    palette = list(ImageColor.getrgb("white"))
+    for color in COLORS:
+        palette.extend(ImageColor.getrgb(color))
+    image = Image.new("P", (1, 1))
+    image.putpalette(palette + [0] * (768 - len(palette)))
+    return image
+
+
+class ImageWriter(object):
+    """
+    Encodes and saves images on background threads so rendering can carry on in the meantime. put() blocks once
+    the queue is full, so no more than a queue's worth of images are ever waiting around. How often files are
+    fsynced is up to the fsync option: never ("none"), every fsync_every files ("batch") or every file ("always")
+    """
+
+    def __init__(self, filetype, options=DEFAULT_WRITER_OPTIONS):
+        """
+        :param filetype: Either png or jpg
+        :param options: WriterOptions
+        """
+        self.filetype = filetype
+        self.options = options
+        self.queue = queue.Queue(options.queue_size)
+        self.errors = []
+        self.directories = set()
+        self.threads = [threading.Thread(target=self.work) for _ in range(max(options.threads, 1))]
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+
+    def put(self, image, path):
+        """
+        Queues an image to be saved
+        :param image: Image object. Do not draw on it afterwards
+        :param path: Where to save it
+        """
+        if self.errors:
+            raise self.errors[0]
+        self.queue.put((image, path))
+
+    def close(self):
+        """
+        Waits for every queued image to be saved, and synced if the fsync option says so
+        """
+        for _ in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        if self.options.fsync != "none":
+            # Make sure the new directory entries are on disk too
+            for directory in self.directories:
+                fd = os.open(directory, os.O_RDONLY)
+                try:
+                    os.fsync(fd)
+                finally:
+                    os.close(fd)
+        if self.errors:
+            raise self.errors[0]
+
+    def work(self):
+        """
+        Runs on each thread. Encodes and writes images off the queue until it gets None
+        """
+        unsynced = []
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            if self.errors:
+                # Keep draining the queue so put() and close() never block forever
+                continue
+            try:
+                image, path = item
+                profiler = PROFILER
+                if profiler is not None:
+                    tic = clock()
+                data = encode_image(image, self.filetype, self.options)
+                if profiler is not None:
+                    toc = clock()
+                    profiler.add("encode", toc - tic)
+                    profiler.count("bytes_written", len(data))
+                    tic = toc
+                fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+                while data:
+                    data = data[os.write(fd, data):]
+                if self.options.fsync == "none":
+                    os.close(fd)
+                else:
+                    self.directories.add(os.path.dirname(path))
+                    unsynced.append(fd)
+                if profiler is not None:
+                    toc = clock()
+                    profiler.add("write", toc - tic)
+                    tic = toc
+                if self.options.fsync != "none" and (self.options.fsync == "always" or
+                                                     len(unsynced) >= self.options.fsync_every):
+                    sync_and_close(unsynced)
+                    if profiler is not None:
+                        profiler.add("fsync", clock() - tic)
+            except Exception as e:
+                self.errors.append(e)
+        try:
+            sync_and_close(unsynced)
+        except Exception as e:
+            self.errors.append(e)
+
+
+def sync_and_close(fds):
+    """
+    fsyncs and closes a list of file descriptors, emptying the list
+    :param fds: List of open file descriptors
+    """
+    while fds:
+        fd = fds.pop()
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+
+def write_label_index(plan, widths, filetype, image_size, directory, subfolders=False, archives=None,
+                      render_size=None):
+    """
+    Writes the labels of every image file next to them, so loaders never need to list directories or parse file
+    names. labels.csv has one row per image with its path (relative to the dataset directory), shape, color,
+    texture, split, number, scale, translation and stripe angle. labels.npz has the same as one array per column,
+    with the shape, color, texture and split as int8 indices into its shapes, colors, textures and splits arrays
+    :param plan: The dataset plan, in archive order with archives
+    :param widths: How many digits to zero pad the image numbers of each shape to. See segment_widths
+    :param filetype: Either png or jpg
     :param image_size: The width and height of each output image
-    :param validation_set: The percentage of images to save into the validation folder
-    :param traindir: The directory to save training data to
-    :param valdir: The directory to save validation data to
-    """
-    for x in xrange(0, count):
-        # Determine color of this particular square
-        if np.random.uniform() < percent_color:
-            color = prototype_color
+    :param directory: The dataset directory
+    :param subfolders: Whether the images are in a folder named after their shape
+    :param archives: Where each range of plan rows goes with --archive, see plan_archives. Adds an archive column
+    :param render_size: The size the images were rendered at before being shrunk to image_size by --image-sizes.
+                        The translations are scaled to image_size pixels
+    """
+    # Plain Python values are a lot quicker to format than NumPy scalars
+    fields = ["shape", "index", "color", "texture", "split"]
+    paths = [image_name(dict(zip(fields, row)), widths, filetype, subfolders) for row in plan[fields].tolist()]
+    if render_size is None or render_size == image_size:
+        translate_x, translate_y = plan_translations(plan, image_size)
+    else:
+        translate_x, translate_y = plan_translations(plan, render_size)
+        translate_x = translate_x * image_size / float(render_size)
+        translate_y = translate_y * image_size / float(render_size)
+    arrays = collections.OrderedDict([("path", np.array(paths, dtype=np.bytes_)),
+                                      ("shape", plan["shape"]),
+                                      ("color", plan["color"]),
+                                      ("texture", plan["texture"]),
+                                      ("split", plan["split"]),
+                                      ("index", plan["index"]),
+                                      ("scale", plan["scale"]),
+                                      ("translate_x", translate_x),
+                                      ("translate_y", translate_y),
+                                      ("angle", plan["angle"])])
+    columns = [paths] + [np.asarray(values).tolist() for values in list(arrays.values())[1:]]
+    # Names instead of indices, so the file makes sense on its own
+    for column, choices in enumerate([SHAPES, COLORS, TEXTURES, SPLITS], 1):
+        columns[column] = [choices[value] for value in columns[column]]
+    if archives is not None:
+        members = [None] * len(plan)
+        for name, start, stop in archives:
+            members[start:stop] = [name] * (stop - start)
+        arrays["archive"] = np.array(members, dtype=np.bytes_)
+        columns.append(members)
+
+    with open(os.path.join(directory, "labels.csv"), "w") as fp:
+        writer = csv.writer(fp, lineterminator="\n")
+        writer.writerow(list(arrays))
+        writer.writerows(zip(*columns))
+    np.savez(os.path.join(directory, "labels.npz"), shapes=SHAPES, colors=COLORS, textures=TEXTURES, splits=SPLITS,
+             **arrays)
+
+
+class ArchiveWriter(object):
+    """
+    Streams files into a tar, tar.gz or zip archive. Every member gets the same timestamp, owner and permissions,
+    and the gzip header leaves out the time and file name, so the same images always make the same archive
+    """
+
+    def __init__(self, path, archive):
+        """
+        :param path: Where to write the archive
+        :param archive: "tar" "tar.gz" or "zip"
+        """
+        self.archive = archive
+        self.fp = open(path, "wb")
+        self.gz = None
+        if archive == "zip":
+            # Images are compressed already, so they are just stored
+            self.out = zipfile.ZipFile(self.fp, "w", zipfile.ZIP_STORED)
         else:
-            color = random.choice(color_choices)
+            fileobj = self.fp
+            if archive == "tar.gz":
+                self.gz = gzip.GzipFile(filename="", mode="wb", compresslevel=6, fileobj=self.fp, mtime=0)
+                fileobj = self.gz
+            self.out = tarfile.open(fileobj=fileobj, mode="w", format=tarfile.USTAR_FORMAT)
 
-        # Ditto for texture
-        if np.random.uniform() < percent_texture:
-            texture = prototype_texture
+    def add(self, name, data):
+        """
+        Adds a file to the end of the archive
+        :param name: Path of the file inside the archive
+        :param data: Its contents, as bytes
+        """
+        if self.archive == "zip":
+            info = zipfile.ZipInfo(name, date_time=(1980, 1, 1, 0, 0, 0))
+            info.create_system = 3
+            info.external_attr = 0o644 << 16
+            self.out.writestr(info, data)
         else:
-            texture = random.choice(texture_choices)
-
-        # Create the image to draw on
-        image = Image.new("RGB", (image_size, image_size), "white")
-
-        # Create the square image object
-        if shape == "square":
-            image = draw_square(image, color, texture)
-        elif shape == "circle":
-            image = draw_circle(image, color, texture)
-        elif shape == "triangle":
-            image = draw_triangle(image, color, texture)
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            info.mtime = 0
+            info.mode = 0o644
+            self.out.addfile(info, io.BytesIO(data))
+
+    def close(self):
+        """
+        Finishes the archive
+        """
+        self.out.close()
+        if self.gz is not None:
+            self.gz.close()
+        self.fp.close()
+
+
+def plan_archives(count, archive, archive_size, archives=(), batches=()):
+    """
+    Decides which archive files the plan is written into: images_00000.tar.gz, images_00001.tar.gz, ... of
+    archive_size images each. Images added later by --extend go in new archives after the existing ones
+    :param count: Number of rows in the plan
+    :param archive: "tar" "tar.gz" or "zip"
+    :param archive_size: How many images go in each archive, 0 for as many as there are
+    :param archives: Archives laid out by an earlier call, kept as they are
+    :param batches: Ditto for the batches
+    :return: List of (archive file name, first row, one past the last row) and list of [first row, one past the
+             last row] of the rows laid out by each call. See archive_order
+    """
+    archives = [tuple(entry) for entry in archives]
+    batches = [list(batch) for batch in batches]
+    first = archives[-1][2] if archives else 0
+    if first < count:
+        batches.append([first, count])
+        size = archive_size if archive_size > 0 else count - first
+        for start in range(first, count, size):
+            archives.append(("images_{0:05d}.{1}".format(len(archives), archive), start, min(start + size, count)))
+    return archives, batches
+
+
+def archive_order(plan, batches, order, seed):
+    """
+    Decides the order images go into the archives. Each batch from plan_archives is only ever reordered within
+    itself, so extending a dataset never moves images that are already archived
+    :param plan: The dataset plan
+    :param batches: List of [first row, one past the last row], see plan_archives
+    :param order: "plan" for shape by shape, "split" for all the training images then all the validation images,
+                  "shuffled" for a random (seeded) order
+    :param seed: The global seed for the dataset
+    :return: Array of plan rows in archive order
+    """
+    rows = []
+    for start, stop in batches:
+        if order == "split":
+            batch = np.argsort(plan["split"][start:stop], kind="mergesort")
+        elif order == "shuffled":
+            batch = np.random.RandomState([seed, 2 * len(SHAPES), start]).permutation(stop - start)
         else:
-            raise IOError("Shape {} incorrect".format(shape))
+            batch = np.arange(stop - start)
+        rows.append(batch + start)
+    if not rows:
+        return np.zeros(0, dtype=np.int64)
+    return np.concatenate(rows)
+
+
+def write_archive(plan, widths, filetype, image_size, path, archive, pool=None, renderer="pil",
+                  writer_options=DEFAULT_WRITER_OPTIONS, subfolders=False):
+    """
+    Renders and encodes the images in the plan (in the pool if there is one) and streams them into an archive in
+    plan order. The archive is written under a temporary name and only renamed once it is complete
+    :param plan: Rows of the dataset plan, in archive order
+    :param widths: How many digits to zero pad the image numbers of each shape to. See segment_widths
+    :param filetype: Either png or jpg
+    :param image_size: The width and height of each output image
+    :param path: Where to write the archive
+    :param archive: "tar" "tar.gz" or "zip"
+    :param pool: Optional multiprocessing pool to render the images with
+    :param renderer: "pil" to draw each image with the draw_* functions or "numpy" to use render_batch_numpy
+    :param writer_options: WriterOptions for encoding the images
+    :param subfolders: Put each image in a folder named after its shape
+    """
+    tasks = [(plan[start:start + CHUNK_SIZE], widths, filetype, image_size, renderer, writer_options, subfolders)
+             for start in range(0, len(plan), CHUNK_SIZE)]
+    if pool is None:
+        results = (encode_plan(task) for task in tasks)
+    else:
+        results = run_ahead(pool, encode_plan, tasks, ARCHIVE_PREFETCH)
+    writer = ArchiveWriter(path + ".tmp", archive)
+    for members, profile in results:
+        if PROFILER is not None:
+            if profile is not None:
+                PROFILER.merge(profile)
+            tic = clock()
+        for name, data in members:
+            writer.add(name, data)
+        if PROFILER is not None:
+            PROFILER.add("archive_write", clock() - tic)
+            PROFILER.count("bytes_written", sum(len(data) for _, data in members))
+            PROFILER.progress(len(members))
+    writer.close()
+    if writer_options.fsync != "none":
+        with open(path + ".tmp", "rb") as fp:
+            os.fsync(fp.fileno())
+    getattr(os, "replace", os.rename)(path + ".tmp", path)
+
+
+def run_ahead(pool, function, tasks, ahead):
+    """
+    Runs tasks in the pool, keeping only so many of them running or finished ahead of the caller
+    :param pool: multiprocessing pool
+    :param function: Function to run on each task
+    :param tasks: List of tasks
+    :param ahead: How many tasks to have running or finished at once
+    :return: Generator of the results, in the order of the tasks
+    """
+    pending = collections.deque()
+    for task in tasks:
+        pending.append(pool.apply_async(function, (task,)))
+        if len(pending) > ahead:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+
+def create_shards(plan, image_size, directory, shard_size, shards=(), shard_index=0, num_shards=1):
+    """
+    Lays the dataset out as arrays that can be opened with np.load(mmap_mode="r"). The images go in
+    images_00000.npy, images_00001.npy, ... each of shape (shard_size, image_size, image_size, 3), the last one
+    shorter. The labels and transform parameters of every image go in one array each, in the same order, and
+    shards.json says what is where. The image shards are created empty for render_plan_to_shard to fill in
+    :param plan: Rows of the dataset plan
+    :param image_size: The width and height of each output image
+    :param directory: The dataset directory
+    :param shard_size: How many images go in each shard
+    :param shards: Shards made by an earlier call for the start of the same plan. They are kept as they are and new
+                   shards are only made for the rows after them
+    :param shard_index: Which of the num_shards slices of the dataset this machine makes. Only the image shards it
+                        makes (see work_units) are created here, but the labels cover the whole dataset
+    :param num_shards: How many machines the dataset is split between
+    :return: List of (shard file name, first row of the plan in it, one past the last row)
+    """
+    shards = [tuple(shard) for shard in shards]
+    first = shards[-1][2] if shards else 0
+    for start in range(first, len(plan), shard_size):
+        stop = min(start + shard_size, len(plan))
+        name = "images_{0:05d}.npy".format(len(shards))
+        if len(shards) % num_shards == shard_index:
+            images = np.lib.format.open_memmap(os.path.join(directory, name), mode="w+", dtype=np.uint8,
+                                               shape=(stop - start, image_size, image_size, 3))
+            del images
+        shards.append((name, start, stop))
+
+    translate_x, translate_y = plan_translations(plan, image_size)
+    labels = {
+        "shape": plan["shape"],
+        "color": plan["color"],
+        "texture": plan["texture"],
+        "split": plan["split"],
+        "index": plan["index"],
+        "angle": plan["angle"],
+        "scale": plan["scale"],
+        "translate_x": translate_x,
+        "translate_y": translate_y,
+    }
+    for name, values in labels.items():
+        np.save(os.path.join(directory, name + ".npy"), np.ascontiguousarray(values))
+
+    with open(os.path.join(directory, "shards.json"), "w") as fp:
+        json.dump({"image_size": image_size,
+                   "count": len(plan),
+                   "shards": [{"file": name, "start": start, "stop": stop} for name, start, stop in shards],
+                   "labels": sorted(name + ".npy" for name in labels),
+                   "shapes": SHAPES,
+                   "colors": COLORS,
+                   "textures": TEXTURES,
+                   "splits": SPLITS}, fp, indent=2, sort_keys=True)
+    return shards
+
+
+def render_plan_to_shard(task):
+    """
+    Renders a slice of the plan into its rows of an image shard made by create_shards
+    :param task: Tuple of (plan rows, image_size, renderer, shard path, first row of the shard to fill)
+    :return: The number of images saved and what the profiler collected (see take_profile)
+    """
+    plan, image_size, renderer, path, offset = task
+    images = render_array(plan, image_size, renderer)
+    if PROFILER is not None:
+        tic = clock()
+    shard = np.load(path, mmap_mode="r+")
+    shard[offset:offset + len(plan)] = images
+    shard.flush()
+    del shard
+    if PROFILER is not None:
+        PROFILER.add("shard_write", clock() - tic)
+        PROFILER.count("bytes_written", images.nbytes)
+    return len(plan), take_profile()
+
+
+def render_array(plan, image_size, renderer="pil"):
+    """
+    Renders a slice of the plan into one array
+    :param plan: Rows of the dataset plan
+    :param image_size: The width and height of each output image
+    :param renderer: "pil" to draw each image with the draw_* functions or "numpy" to use render_batch_numpy
+    :return: uint8 array of shape (len(plan), image_size, image_size, 3)
+    """
+    if renderer == "numpy":
+        return render_batch_numpy(plan, image_size)
+    images = np.empty((len(plan), image_size, image_size, 3), dtype=np.uint8)
+    for i, row in enumerate(plan):
+        images[i] = np.asarray(render_image(row, image_size))
+    return images
+
+
+def render_images(plan, image_size, renderer="pil"):
+    """
+    Renders a slice of the plan one image at a time
+    :param plan: Rows of the dataset plan
+    :param image_size: The width and height of each output image
+    :param renderer: "pil" to draw each image with the draw_* functions or "numpy" to use render_batch_numpy
+    :return: Generator of Image objects, one per row
+    """
+    if renderer == "numpy":
+        for array in render_batch_numpy(plan, image_size):
+            yield Image.fromarray(array)
+    else:
+        for row in plan:
+            yield render_image(row, image_size)
+
+
+def render_image(row, image_size):
+    """
+    Draws the image described by one row of the plan, starting from the cached drawing of its shape
+    :param row: A row of the dataset plan
+    :param image_size: The width and height of each output image
+    :return: Image object
+    """
+    profiler = PROFILER
+    if profiler is not None:
+        tic = clock()
+    shape = SHAPES[row["shape"]]
+    color = COLORS[row["color"]]
+    template, stripe_mask = TEMPLATE_CACHE.get(shape, color, TEXTURES[row["texture"]], image_size)
+    if profiler is not None:
+        toc = clock()
+        profiler.add("template", toc - tic)
+        tic = toc
+    if stripe_mask is not None:
+        # Fill the inside of the shape with stripes rotated by the planned angle
+        stripes = STRIPE_CACHE.get(color, row["angle"], image_size)
+        if profiler is not None:
+            toc = clock()
+            profiler.add("stripes", toc - tic)
+            tic = toc
+        template = Image.composite(stripes, template, stripe_mask)
+        if profiler is not None:
+            toc = clock()
+            profiler.add("composite", toc - tic)
+            tic = toc
+
+    # Scale and move the shape to a new image by the planned amounts
+    inset = CIRCLE_INSET if shape == "circle" else POLYGON_INSET
+    image = place_shape(template, row["scale"], (row["shift_x"], row["shift_y"]), inset)
+    if profiler is not None:
+        profiler.add("transform", clock() - tic)
+    return image
+
+
+def translation(shift, new_width, image_size):
+    """
+    Turns a planned shift into a translation that keeps the scaled image inside the output
+    :param shift: Number in [0, 1) drawn by the planner
+    :param new_width: Width of the scaled image
+    :param image_size: The width and height of each output image
+    :return: The translation to hand to the affine transform, between new_width - image_size and 0
+    """
+    return new_width - image_size + int(shift * (image_size - new_width + 1))
 
-        # Save the image, dir/training/shape_number_color_texture.png, zero pad the outputs
-        fname = "{0}/{1}_{2:0{3}d}_{4}_{5}.{6}".format(traindir,
-                                                       shape, x, len(str(count - 1)),
-                                                       color, texture, filetype)
-        with open(fname, "w") as fp:
-            image.save(fp)
 
-    if validation_set > 0:
-        # Take the newly saved files and put some of them into the validation directory
-        validation_num = int(count * validation_set)
-        split_validation_set(traindir, valdir, validation_num)
+def plan_translations(plan, image_size):
+    """
+    Works out the translations place_shape uses for a whole slice of the plan at once
+    :param plan: Rows of the dataset plan
+    :param image_size: The width and height of each output image
+    :return: Pair of int arrays, the x and y translations
+    """
+    new_width = np.minimum(image_size, np.ceil(image_size / plan["scale"] - 0.5)).astype(np.int64)
+    return tuple(new_width - image_size + (shift * (image_size - new_width + 1)).astype(np.int64)
+                 for shift in (plan["shift_x"], plan["shift_y"]))
 
 
-def split_validation_set(traindir, valdir, validation_num):
+def scaled_width(scale_factor, image_size):
     """
-    Move some number of files from the training directory into a newly created validation directory
-    :param traindir: The directory the training data was saved to. Images will be moved from here to..
-    :param valdir: ..here.
-    :param validation_num: The number of files to move
+    Works out how wide the image is after shrinking it by the scale factor. This is what getbbox() would find
+    after the scaling transform, since the transform samples pixel centers and leaves everything else black
+    :param scale_factor: How much the image is shrunk by
+    :param image_size: The width and height of each output image
+    :return: The width in pixels
+    """
+    return min(image_size, int(math.ceil(image_size / float(scale_factor) - 0.5)))
+
+
+def place_shape(image, scale_factor, shift, inset):
     """
-    # Get a list of all the files we just created with their full paths
-    training_file_list = [os.path.join(traindir, f) for f in os.listdir(traindir) if f.endswith(".png")]
-    # Get the random indices to pull from the training file list
-    validation_idxs = random.sample(range(len(training_file_list)), validation_num)
-    for index in validation_idxs:
-        src = training_file_list[index]
-        filename = os.path.basename(src)
-        dest = os.path.join(valdir, filename)
-        os.rename(src, dest)
+    Shrinks the drawing and moves it to its planned spot on a white image in a single affine transform. Only the
+    part of the output that ends up covered by the drawing gets transformed, so there is no mask or composite
+    :param image: The full size drawing of the shape
+    :param scale_factor: How much to shrink the shape by, between 1 and 4
+    :param shift: Pair of numbers in [0, 1) that pick where the shape is moved to
+    :param inset: (left/top, right/bottom) pixels trimmed off the edges of the shrunk drawing
+    :return: Image object containing the shape at its final size and position
+    """
+    image_size = image.size[0]
+    new_width = scaled_width(scale_factor, image_size)
+    # Where the shrunk drawing is allowed to be translated to
+    translate_x = translation(shift[0], new_width, image_size)
+    translate_y = translation(shift[1], new_width, image_size)
+
+    # The box of the output covered by the shrunk drawing, minus the trimmed edges
+    left = inset[0] - translate_x
+    top = inset[0] - translate_y
+    width = new_width - inset[0] - inset[1]
+    # Output pixel (x, y) of the region comes from drawing pixel ((x + left + translate_x) * scale_factor, ...)
+    params = (
+        scale_factor, 0, (left + translate_x) * scale_factor,
+        0, scale_factor, (top + translate_y) * scale_factor
+    )
+    output_image = Image.new("RGB", (image_size, image_size), "white")
+    if width > 0:
+        output_image.paste(image.transform((width, width), Image.AFFINE, params), (left, top))
+    return output_image
 
 
 def draw_circle(image, color, texture):
@@ -113,12 +1358,11 @@ def draw_circle(image, color, texture):
     :param image: The image object to draw on
     :param color: "red" "green" "blue" or "black"
     :param texture: "solid" "striped" or "blank"
-    :return: Image object containing a circle
+    :return: For striped circles, the mask of where the stripes go. The stripes themselves are not drawn. None
+             otherwise
     """
     # Images are all square so just take the width and use it
     image_size = image.size[0]
-    # Create the image to draw on
-    output_image = Image.new("RGB", (image_size, image_size), "white")
     circle = ImageDraw.Draw(image)
 
     # Draw a circle the size of the image and apply the correct texture
@@ -127,56 +1371,17 @@ def draw_circle(image, color, texture):
     else:
         circle.ellipse([(5, 5), (image_size - 5, image_size - 5)], "white", color)
 
+    # Delete the drawing object because that's what the docs say to do and who cares
+    del circle
+
     if texture == "striped":
-        # Rotate the stripe image a random amount and crop it down to the correct size
-        stripes_size = image_size * 2
-        angle = random.randint(0, 180)
-        tmpimg = STRIPES[color].rotate(angle)
-        # Make sure we are centered on the image so we don't get any of the rotation artifacts
-        tmpimg = tmpimg.crop((stripes_size/4, stripes_size/4,
-                              stripes_size - stripes_size/4, stripes_size - stripes_size/4))
         # Use the circle as a mask over the stripes
         mask = Image.new("1", (image_size, image_size), 0)  # Start with a black image
         mask_circle = ImageDraw.Draw(mask)
         mask_circle.ellipse([(7, 7), (image_size - 7, image_size - 7)], 1, 1)
         del mask_circle
-        image = Image.composite(tmpimg, image, mask)
-
-    # Delete the drawing object because that's what the docs say to do and who cares
-    del circle
-    # Randomly scale and move the circle to a new image
-    scale_factor = random.uniform(1, 4)
-    scale_params = (
-        scale_factor, 0, 0,
-        0, scale_factor, 0
-    )
-    image = image.transform((image_size, image_size), Image.AFFINE, scale_params)
-
-    # Get the bounding box of the newly transformed circle
-    box = image.getbbox()
-    new_diameter = box[2] - box[0]
-    # Use the bounding box to determine where the circle is allowed to be translated to
-    translate_x = random.randint(new_diameter - image_size, 0)
-    translate_y = random.randint(new_diameter - image_size, 0)
-    translate_params = (
-        1, 0, translate_x,
-        0, 1, translate_y
-    )
-    image = image.transform((image_size, image_size), Image.AFFINE, translate_params)
-
-    # Give the image a white background
-
-    # Get the new bounding box of the newly transformed circle
-    box = image.getbbox()
-    # Create a new mask using the bounding box
-    mask = Image.new("1", (image_size, image_size), 0)
-    mask_box = ImageDraw.Draw(mask)
-    mask_box.rectangle(box, 1, 0)
-    del mask_box
-    # Apply the mask to the circle
-    output_image = Image.composite(image, output_image, mask)
-
-    return output_image
+        return mask
+    return None
 
 
 def draw_square(image, color, texture):
@@ -185,72 +1390,32 @@ def draw_square(image, color, texture):
     :param image: The image object to draw on
     :param color: "red" "green" "blue" or "black"
     :param texture: "solid" "striped" or "blank"
-    :return: Image object containing a square
+    :return: For striped squares, the mask of where the stripes go. The stripes themselves are not drawn. None
+             otherwise
     """
     # Images are all square so just take the width and use it
     image_size = image.size[0]
-    # Create the image to draw on
-    output_image = Image.new("RGB", (image_size, image_size), "white")
     square = ImageDraw.Draw(image)
 
     # Draw a square roughly the size of the image and apply the correct texture
     if texture == "solid":
         square.rectangle([(5, 5), (image_size - 5, image_size - 5)], color, color)
     else:
-        for i in xrange(0, 5):
+        for i in range(0, 5):
             # Draw multiple rectangles to get the correct line thickness. Ugh.
             square.rectangle([(10 + i, 10 + i), (image_size - 10 - i, image_size - 10 - i)], "white", color)
 
+    # Delete the drawing object because that's what the docs say to do and who cares
+    del square
+
     if texture == "striped":
-        # Rotate the stripe image a random amount and crop it down to the correct size
-        stripes_size = image_size * 2
-        angle = random.randint(0, 180)
-        tmpimg = STRIPES[color].rotate(angle)
-        # Make sure we are centered on the image so we don't get any of the rotation artifacts
-        tmpimg = tmpimg.crop((stripes_size / 4, stripes_size / 4,
-                              stripes_size - stripes_size / 4, stripes_size - stripes_size / 4))
-        # Use the circle as a mask over the stripes
+        # Use the square as a mask over the stripes
         mask = Image.new("1", (image_size, image_size), 0)  # Start with a black image
         mask_square = ImageDraw.Draw(mask)
         mask_square.rectangle([(15, 15), (image_size - 15, image_size - 15)], 1, 1)
         del mask_square
-        image = Image.composite(tmpimg, image, mask)
-
-    # Delete the drawing object because that's what the docs say to do and who cares
-    del square
-    # Randomly scale and move the square to a new image
-    scale_factor = random.uniform(1, 4)
-    scale_params = (
-        scale_factor, 0, 0,
-        0, scale_factor, 0
-    )
-    image = image.transform((image_size, image_size), Image.AFFINE, scale_params)
-
-    # Get the bounding box of the newly transformed square
-    box = image.getbbox()
-    new_width = box[2] - box[0]
-    # Use the bounding box to determine where the circle is allowed to be translated to
-    translate_x = random.randint(new_width - image_size, 0)
-    translate_y = random.randint(new_width - image_size, 0)
-    translate_params = (
-        1, 0, translate_x,
-        0, 1, translate_y
-    )
-    image = image.transform((image_size, image_size), Image.AFFINE, translate_params)
-
-    # Give the image a white background
-
-    # Get the new bounding box of the newly transformed square
-    box = image.getbbox()
-    box = (box[0] + 1, box[1] + 1, box[2] - 1, box[3] - 1)
-    # Create a new mask using the bounding box
-    mask = Image.new("1", (image_size, image_size), 0)
-    mask_box = ImageDraw.Draw(mask)
-    mask_box.rectangle(box, 1, 0)
-    del mask_box
-    # Apply the mask to the square
-    output_image = Image.composite(image, output_image, mask)
-    return output_image
+        return mask
+    return None
 
 
 def draw_triangle(image, color, texture):
@@ -259,14 +1424,13 @@ def draw_triangle(image, color, texture):
     :param image: The image object to draw on
     :param color: "red" "green" "blue" or "black"
     :param texture: "solid" "striped" or "blank"
-    :return: Image object containing a triangle
+    :return: For striped triangles, the mask of where the stripes go. The stripes themselves are not drawn. None
+             otherwise
     """
     # Images are all square so just take the width and use it
     image_size = image.size[0]
-    # Create the image to draw on
-    output_image = Image.new("RGB", (image_size, image_size), "white")
     triangle = ImageDraw.Draw(image)
-    top = (image_size / 2, 10)
+    top = (image_size // 2, 10)
     bottom_left = (10, image_size - 10)
     bottom_right = (image_size - 10, image_size - 10)
 
@@ -279,15 +1443,11 @@ def draw_triangle(image, color, texture):
                           (bottom_right[0] - 5, bottom_right[1] - 5)],
                          "white", color)
 
+    # Delete the drawing object because that's what the docs say to do and who cares
+    del triangle
+
     if texture == "striped":
-        # Rotate the stripe image a random amount and crop it down to the correct size
-        stripes_size = image_size * 2
-        angle = random.randint(0, 180)
-        tmpimg = STRIPES[color].rotate(angle)
-        # Make sure we are centered on the image so we don't get any of the rotation artifacts
-        tmpimg = tmpimg.crop((stripes_size / 4, stripes_size / 4,
-                              stripes_size - stripes_size / 4, stripes_size - stripes_size / 4))
-        # Use the circle as a mask over the stripes
+        # Use the inner triangle as a mask over the stripes
         mask = Image.new("1", (image_size, image_size), 0)  # Start with a black image
         mask_triangle = ImageDraw.Draw(mask)
         mask_triangle.polygon([(top[0], top[1] + 10),
@@ -295,54 +1455,428 @@ def draw_triangle(image, color, texture):
                                (bottom_right[0] - 5, bottom_right[1] - 5)],
                               1, 1)
         del mask_triangle
-        image = Image.composite(tmpimg, image, mask)
+        return mask
+    return None
 
-    # Delete the drawing object because that's what the docs say to do and who cares
-    del triangle
-    # Randomly scale and move the square to a new image
-    scale_factor = random.uniform(1, 4)
-    scale_params = (
-        scale_factor, 0, 0,
-        0, scale_factor, 0
-    )
-    image = image.transform((image_size, image_size), Image.AFFINE, scale_params)
-
-    # Get the bounding box of the newly transformed square
-    box = image.getbbox()
-    new_width = box[2] - box[0]
-    # Use the bounding box to determine where the circle is allowed to be translated to
-    translate_x = random.randint(new_width - image_size, 0)
-    translate_y = random.randint(new_width - image_size, 0)
-    translate_params = (
-        1, 0, translate_x,
-        0, 1, translate_y
-    )
-    image = image.transform((image_size, image_size), Image.AFFINE, translate_params)
-
-    # Give the image a white background
-
-    # Get the new bounding box of the newly transformed square
-    box = image.getbbox()
-    box = (box[0] + 1, box[1] + 1, box[2] - 1, box[3] - 1)
-    # Create a new mask using the bounding box
-    mask = Image.new("1", (image_size, image_size), 0)
-    mask_box = ImageDraw.Draw(mask)
-    mask_box.rectangle(box, 1, 0)
-    del mask_box
-    # Apply the mask to the square
-    output_image = Image.composite(image, output_image, mask)
-    return output_image
 
+class TemplateCache(object):
+    """
+    Keeps the full size drawing of every (shape, color, texture, image size) around so it only gets drawn once.
+    Striped templates are drawn without their stripes and come with the mask the stripes go through. There are
+    only 36 of them per image size so nothing is ever thrown away
+    """
+
+    def __init__(self):
+        self.templates = dict()
+        self.arrays = dict()
+
+    def get(self, shape, color, texture, image_size):
+        """
+        :param shape: "square" "circle" or "triangle"
+        :param color: "red" "green" "blue" or "black"
+        :param texture: "solid" "striped" or "blank"
+        :param image_size: The width and height of each output image
+        :return: Pair of the drawing and the stripe mask (None unless striped). Do not draw on either of them
+        """
+        key = (shape, color, texture, image_size)
+        if key not in self.templates:
+            image = Image.new("RGB", (image_size, image_size), "white")
+            if shape == "square":
+                mask = draw_square(image, color, texture)
+            elif shape == "circle":
+                mask = draw_circle(image, color, texture)
+            elif shape == "triangle":
+                mask = draw_triangle(image, color, texture)
+            else:
+                raise IOError("Shape {} incorrect".format(shape))
+            self.templates[key] = (image, mask)
+        return self.templates[key]
+
+    def masks(self, shape, texture, image_size):
+        """
+        The NumPy renderer's version of the templates. See shape_masks
+        :param shape: "square" "circle" or "triangle"
+        :param texture: "solid" "striped" or "blank"
+        :param image_size: The width and height of each output image
+        :return: Pair of boolean (image_size, image_size) arrays, the fill and where the stripes go
+        """
+        key = (shape, texture, image_size)
+        if key not in self.arrays:
+            self.arrays[key] = shape_masks(shape, texture, image_size)
+        return self.arrays[key]
 
-def run():
+    def prewarm(self, color_choices, texture_choices, image_size):
+        """
+        Draws every template up front
+        :param color_choices: List of possible colors
+        :param texture_choices: List of possible textures
+        :param image_size: The width and height of each output image
+        """
+        for shape in SHAPES:
+            for color in color_choices:
+                for texture in texture_choices:
+                    self.get(shape, color, texture, image_size)
+
+
+# Like STRIPES, so every template only gets drawn once per process
+TEMPLATE_CACHE = TemplateCache()
+
+
+def render_batch_numpy(plan, image_size):
     """
-    Parses the arguments and generates the image data. Saves files as it goes to conserve RAM
-    If stats are not specified they will be generate
+    Renders a whole slice of the plan with NumPy instead of drawing each image with PIL. Looks the same as the
+    draw_* functions give or take a few pixels along the edges of the shapes and stripes
+    :param plan: Rows of the dataset plan
+    :param image_size: The width and height of each output image
+    :return: uint8 array of shape (len(plan), image_size, image_size, 3)
+    """
+    profiler = PROFILER
+    images = np.empty((len(plan), image_size, image_size, 3), dtype=np.uint8)
+    # Images of a similar scale are rendered together so they can share a similarly sized window. Working
+    # through the batch in pieces also keeps the intermediate arrays a reasonable size
+    order = np.argsort(plan["scale"], kind="mergesort")
+    for start in range(0, len(plan), NUMPY_BATCH):
+        if profiler is not None:
+            tic = clock()
+        rows = order[start:start + NUMPY_BATCH]
+        images[rows] = render_rows_numpy(plan[rows], image_size)
+        if profiler is not None:
+            # Counted per image so it compares with the PIL stages
+            seconds = (clock() - tic) / len(rows)
+            for _ in rows:
+                profiler.add("render_numpy", seconds)
+    return images
+
+
+def render_rows_numpy(plan, image_size):
+    """
+    Renders rows of the plan in one go by working out, for every pixel covered by a shrunk drawing, which pixel
+    of the full size drawing it comes from and looking up whether that pixel is part of the shape.
+    See render_batch_numpy
+    :param plan: Rows of the dataset plan
+    :param image_size: The width and height of each output image
+    :return: uint8 array of shape (len(plan), image_size, image_size, 3)
+    """
+    scale_factor = plan["scale"][:, None]
+    # Same placement as place_shape, for every image at once
+    new_width = np.minimum(image_size, np.ceil(image_size / plan["scale"] - 0.5)).astype(np.int64)
+    is_circle = plan["shape"] == SHAPES.index("circle")
+    inset_start = np.where(is_circle, CIRCLE_INSET[0], POLYGON_INSET[0])
+    width = new_width - inset_start - np.where(is_circle, CIRCLE_INSET[1], POLYGON_INSET[1])
+    # Every image is worked out in a window big enough for the largest drawing in the batch
+    window = np.arange(max(width.max(), 0))
+
+    corners = []
+    sources = []
+    for translate in plan_translations(plan, image_size):
+        corner = inset_start - translate
+        corners.append(corner)
+        # The pixel of the full size drawing each row or column of the window is sampled from
+        source = np.floor(scale_factor * (window + 0.5) + (corner + translate)[:, None] * scale_factor)
+        sources.append(np.clip(source, 0, image_size - 1).astype(np.intp))
+    u, v = sources
+    flat = v[:, :, None] * image_size + u[:, None, :]
+
+    colored = np.zeros((len(plan), len(window), len(window)), dtype=bool)
+    for shape_id, shape in enumerate(SHAPES):
+        for texture_id, texture in enumerate(TEXTURES):
+            selected = np.nonzero((plan["shape"] == shape_id) & (plan["texture"] == texture_id))[0]
+            if not len(selected):
+                continue
+            fill, stripes = TEMPLATE_CACHE.masks(shape, texture, image_size)
+            colored[selected] = fill.take(flat[selected])
+            if texture == "striped":
+                colored[selected] |= stripes.take(flat[selected]) & stripe_mask(
+                    u[selected][:, None, :], v[selected][:, :, None], plan["angle"][selected][:, None, None],
+                    image_size)
+
+    # White everywhere except the shape, which gets its color
+    rgb = np.array([ImageColor.getrgb(color) for color in COLORS], dtype=np.uint8)[plan["color"]]
+    images = np.full((len(plan), image_size, image_size, 3), 255, dtype=np.uint8)
+    for i in range(len(plan)):
+        box = images[i, corners[1][i]:corners[1][i] + width[i], corners[0][i]:corners[0][i] + width[i]]
+        np.copyto(box, rgb[i], where=colored[i, :width[i], :width[i], None])
+    return images
+
+
+def shape_masks(shape, texture, image_size):
+    """
+    Works out which pixels of the full size drawing are colored in, matching draw_circle, draw_square and
+    draw_triangle before they scale and move the shape
+    :param shape: "square" "circle" or "triangle"
+    :param texture: "solid" "striped" or "blank"
+    :param image_size: The width and height of each output image
+    :return: Pair of boolean (image_size, image_size) arrays. The first is True where the drawing has the shape's
+             color, the second where the stripes show through instead
+    """
+    u = np.arange(image_size)[None, :]
+    v = np.arange(image_size)[:, None]
+    stripes = np.zeros((image_size, image_size), dtype=bool)
+    if shape == "circle":
+        center = image_size / 2.0
+        distance = np.hypot(u - center, v - center)
+        # PIL's ellipses include both edges of their bounding box, hence the extra half pixel
+        fill = distance <= (image_size - 9) / 2.0
+        if texture != "solid":
+            # One pixel outline, with the stripes inside a slightly smaller circle
+            fill &= distance > (image_size - 11) / 2.0
+            stripes = distance <= (image_size - 13) / 2.0
+    elif shape == "square":
+        if texture == "solid":
+            fill = in_box(u, v, 5, image_size - 5)
+        else:
+            # Five pixel border, with the stripes inside it
+            fill = in_box(u, v, 10, image_size - 10) & ~in_box(u, v, 15, image_size - 15)
+            stripes = in_box(u, v, 15, image_size - 15)
+    elif shape == "triangle":
+        fill = in_triangle(u, v, (image_size / 2.0, 10), (10, image_size - 10), (image_size - 10, image_size - 10))
+        if texture == "striped":
+            # The stripes cover the inner triangle's outline too
+            stripes = in_triangle(u, v, (image_size / 2.0, 20), (15, image_size - 15),
+                                  (image_size - 15, image_size - 15))
+            fill &= ~stripes
+        elif texture != "solid":
+            # The inner triangle's outline is drawn in the shape's color
+            fill &= ~in_triangle(u, v, (image_size / 2.0, 21), (16, image_size - 16),
+                                 (image_size - 16, image_size - 16))
+    else:
+        raise IOError("Shape {} incorrect".format(shape))
+
+    if texture != "striped":
+        stripes[:] = False
+    return fill, stripes
+
+
+def in_box(u, v, low, high):
     """
+    :return: True where (u, v) is inside the square from (low, low) to (high, high), edges included
+    """
+    return (u >= low) & (u <= high) & (v >= low) & (v <= high)
+
+
+def in_triangle(u, v, top, bottom_left, bottom_right):
+    """
+    :return: True where (u, v) is inside the triangle with a flat bottom and the given corners, edges included
+    """
+    left_edge = (top[0] - bottom_left[0]) * (v - bottom_left[1]) - (top[1] - bottom_left[1]) * (u - bottom_left[0])
+    right_edge = (bottom_right[0] - top[0]) * (v - top[1]) - (bottom_right[1] - top[1]) * (u - top[0])
+    return (left_edge >= 0) & (right_edge >= 0) & (v <= bottom_left[1])
+
+
+def stripe_lookup(image_size):
+    """
+    :return: Boolean array, True for the rows of the double size STRIPES image (shifted down by one) with a stripe
+    """
+    return np.arange(image_size * 4) % 20 < 3
+
+
+def stripe_mask(u, v, angle, image_size):
+    """
+    Works out which pixels of the rotated and cropped STRIPES image are on a stripe without rotating anything
+    :param u: x coordinates in the cropped stripe image
+    :param v: y coordinates in the cropped stripe image, broadcastable against u
+    :param angle: Rotation in degrees, broadcastable against u
+    :param image_size: The width and height of each output image
+    :return: Boolean array, True on the 3 pixel wide stripes drawn every 20 pixels
+    """
+    # Undo the rotation about the center of the double size stripe image. The crop starts a quarter of the way in.
+    # Everything ends up positive so truncating is the same as flooring
+    theta = np.deg2rad(angle)
+    x = (np.sin(theta) * (u + image_size // 2 + 0.5 - image_size)).astype(np.float32)
+    y = (np.cos(theta) * (v + image_size // 2 + 0.5 - image_size) + image_size + 1).astype(np.float32)
+    return stripe_lookup(image_size).take((x + y).astype(np.intp))
+
+
+def iter_batches(spec, batch_size, seed, workers=0, prefetch=2, renderer="pil", shuffle=False, split=None):
+    """
+    Generates the dataset described by the spec in memory, a batch at a time, without writing anything to disk.
+    The images are exactly the ones run() would save for the same spec and seed. With workers, batches are
+    rendered in the background while the caller works on the current one
+    :param spec: DatasetSpec, see spec_from_args
+    :param batch_size: How many images to put in each batch. The last batch may be smaller
+    :param seed: The global seed for the dataset
+    :param workers: Number of processes to render with. 0 renders each batch when it is asked for
+    :param prefetch: How many batches to have rendered or rendering ahead of the caller. Bounds the memory used
+    :param renderer: "pil" to draw each image with the draw_* functions or "numpy" to use render_batch_numpy
+    :param shuffle: Serve the images in a random (seeded) order instead of shape by shape
+    :param split: "training" or "validation" to only serve that part of the dataset, None for everything
+    :return: Generator of (images, labels) pairs. images is a uint8 array of shape
+             (batch_size, image_size, image_size, 3) and labels are the matching rows of the plan (PLAN_DTYPE)
+    """
+    plan = plan_dataset(spec.shapes, seed, spec.validation_split)
+    if split is not None:
+        plan = plan[plan["split"] == SPLITS.index(split)]
+    if shuffle:
+        plan = plan[np.random.RandomState([seed, 2 * len(SHAPES)]).permutation(len(plan))]
+    batches = [plan[start:start + batch_size] for start in range(0, len(plan), batch_size)]
+
+    if workers < 1:
+        init_worker(spec.image_size, COLORS)
+        for batch in batches:
+            yield render_array(batch, spec.image_size, renderer), batch
+        return
+
+    pool = multiprocessing.Pool(workers, init_worker, (spec.image_size, COLORS))
+    try:
+        pending = collections.deque()
+        for batch in batches:
+            pending.append((pool.apply_async(render_array, (batch, spec.image_size, renderer)), batch))
+            # Only run ahead of the caller by so much
+            if len(pending) > prefetch:
+                result, labels = pending.popleft()
+                yield result.get(), labels
+        while pending:
+            result, labels = pending.popleft()
+            yield result.get(), labels
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def dataset_roots(directory, image_sizes=None):
+    """
+    :param directory: The dataset directory
+    :param image_sizes: The sizes from --image-sizes, None if there is only one
+    :return: List of the directories the images (and their label index) are saved in, one per size
+    """
+    if image_sizes is None:
+        return [directory]
+    return [os.path.join(directory, str(size)) for size in image_sizes]
+
 
-    # Parse the command line arguments
-    color_choices = {"red", "green", "blue", "black"}
-    texture_choices = {"striped", "solid", "blank"}
+def manifest_from_args(args):
+    """
+    Starts the manifest of a new dataset. Everything that decides what the images look like goes in it, so
+    --resume and --extend can plan exactly the same images again without the original arguments
+    :param args: The namespace object returned by parse_args(), with the seed chosen
+    :return: Dict to pass to save_manifest
+    """
+    spec = spec_from_args(args)
+    return {"seed": args.seed,
+            "image_size": args.image_size,
+            "validation_split": args.validation_split,
+            "filetype": args.filetype,
+            "format": args.format,
+            "renderer": args.renderer,
+            "shard_size": args.shard_size,
+            "archive": args.archive,
+            "archive_size": args.archive_size,
+            "archive_order": args.archive_order,
+            "subfolder_labels": args.subfolder_labels,
+            "image_sizes": args.image_sizes,
+            # How the files are encoded, so the images saved after a --resume or --extend match the rest
+            "png_compress_level": args.png_compress_level,
+            "png_optimize": args.png_optimize,
+            "palette": args.palette,
+            "jpeg_quality": args.jpeg_quality,
+            "jpeg_subsampling": args.jpeg_subsampling,
+            # Which slice of the dataset this directory holds. See work_units and merge_dataset.py
+            "shard_index": args.shard_index,
+            "num_shards": args.num_shards,
+            "shapes": [dict(stats._asdict()) for stats in spec.shapes],
+            # Kept as they are when extending, so the images already saved keep their names. See segment_widths
+            "widths": index_widths(spec.shapes, args.index_digits),
+            # Ranges of image numbers, in the order their rows appear in the plan. See plan_segments
+            "segments": [[stats.shape, 0, stats.count] for stats in spec.shapes],
+            # Ranges of plan rows that are saved. With --archive the rows are counted in archive order
+            "completed": []}
+
+
+def args_from_manifest(args, manifest):
+    """
+    Overwrites the arguments that decide what the images look like with the ones in the manifest
+    :param args: The namespace object returned by parse_args()
+    :param manifest: Dict loaded by load_manifest
+    """
+    for name in ["seed", "image_size", "validation_split", "filetype", "format", "renderer", "shard_size",
+                 "archive", "archive_size", "archive_order", "subfolder_labels", "image_sizes", "shard_index",
+                 "num_shards"]:
+        setattr(args, name, manifest[name])
+    # Manifests from before the encoder settings were saved leave them to the arguments
+    for name in ["png_compress_level", "png_optimize", "palette", "jpeg_quality", "jpeg_subsampling"]:
+        if name in manifest:
+            setattr(args, name, manifest[name])
+    for stats in manifest["shapes"]:
+        for field in ShapeSpec._fields[1:]:
+            setattr(args, "{}_{}".format(stats["shape"], field), stats[field])
+
+
+def extend_manifest(manifest, args):
+    """
+    Adds the images asked for by --square-number, --circle-number and --triangle-number to the end of a dataset,
+    numbered on from the images it already has and with the same statistics
+    :param manifest: Dict loaded by load_manifest
+    :param args: The namespace object returned by parse_args()
+    """
+    for stats in manifest["shapes"]:
+        extra = getattr(args, stats["shape"] + "_number") or 0
+        if extra > 0:
+            width = segment_widths(manifest["widths"], manifest["segments"])[SHAPES.index(stats["shape"])][-1][1]
+            if len(str(stats["count"] + extra - 1)) > width:
+                print("The new {0} numbers are padded to {1} digits, the ones already saved to {2}. Make datasets "
+                      "you will extend with --index-digits to keep every name the same width".format(
+                          stats["shape"], len(str(stats["count"] + extra - 1)), width))
+            manifest["segments"].append([stats["shape"], stats["count"], stats["count"] + extra])
+            stats["count"] += extra
+
+
+def realized_statistics(spec, plan):
+    """
+    Compares how often each shape came out in its prototypical color and texture with how often it was asked to.
+    A shape that is not the prototype is given a random choice, which can still land on the prototype, so the
+    expected fraction is percent + (1 - percent) / number of choices
+    :param spec: DatasetSpec the plan was made from
+    :param plan: Plan from plan_dataset
+    :return: Dict of shape name to its requested, expected and realized fractions. Shapes with no images, or
+             without a prototype and percent for both color and texture, are left out
+    """
+    statistics = dict()
+    for shape_spec in spec.shapes:
+        if not shape_spec.count or None in shape_spec:
+            continue
+        rows = plan[plan["shape"] == SHAPES.index(shape_spec.shape)]
+        shape_statistics = {"count": len(rows)}
+        for attribute, choices in (("color", COLORS), ("texture", TEXTURES)):
+            prototype = getattr(shape_spec, attribute)
+            percent = getattr(shape_spec, "percent_" + attribute)
+            counts = np.bincount(rows[attribute], minlength=len(choices))
+            shape_statistics[attribute] = {
+                "prototype": prototype,
+                "requested_percent": percent,
+                "expected_fraction": percent + (1 - percent) / float(len(choices)),
+                "realized_fraction": counts[choices.index(prototype)] / float(max(len(rows), 1)),
+                "counts": dict(zip(choices, counts.tolist()))}
+        statistics[shape_spec.shape] = shape_statistics
+    return statistics
+
+
+def print_report(report):
+    """
+    Prints the parts of a profiling report (see Profiler.report) that are worth a quick look
+    :param report: The report
+    """
+    print("{} images in {:.2f}s, {:.1f} images/sec, {:.1f}MB written".format(
+        report["images"], report["seconds"], report["images_per_sec"],
+        report["counters"].get("bytes_written", 0) / (1024.0 * 1024.0)))
+    print("{:<14} {:>9} {:>12} {:>12}".format("stage", "count", "total s", "mean us"))
+    for stage, entry in sorted(report["stages"].items(), key=lambda item: -item[1]["total_seconds"]):
+        print("{:<14} {:>9} {:>12.3f} {:>12.1f}".format(stage, entry["count"], entry["total_seconds"],
+                                                       entry["mean_microseconds"]))
+    for shape, shape_statistics in sorted(report["statistics"].items()):
+        for attribute in ("color", "texture"):
+            entry = shape_statistics[attribute]
+            print("{} {} {}: expected {:.3f}, got {:.3f}".format(shape, attribute, entry["prototype"],
+                                                                 entry["expected_fraction"],
+                                                                 entry["realized_fraction"]))
+
+
+def build_parser():
+    """
+    Sets up the command line arguments
+    :return: argparse.ArgumentParser
+    """
+    color_choices = COLORS
+    texture_choices = TEXTURES
     parser = argparse.ArgumentParser(prog="generate_dataset.py",
                                      description="Script to generate prototype images for research on category "
                                                  "development. Generates images which conform to certain statistics "
@@ -360,6 +1894,71 @@ def run():
                         help="What to save the output images as",
                         default="png",
                         choices=["jpg", "png"])
+    parser.add_argument("--format",
+                        help="files writes one image file per image. npy-shards writes the images into .npy arrays "
+                             "of --shard-size images each, plus one array per label, for loading with "
+                             "np.load(mmap_mode=\"r\")",
+                        default="files",
+                        choices=["files", "npy-shards"])
+    parser.add_argument("--shard-size",
+                        help="How many images go in each array with --format npy-shards",
+                        type=positive_int,
+                        default=SHARD_SIZE)
+    parser.add_argument("--index-digits",
+                        help="Zero pad the image numbers to at least this many digits, e.g. 6 for square_000012. "
+                             "Leaves room to --extend the dataset without the new names getting wider",
+                        type=int,
+                        default=0)
+    parser.add_argument("--subfolder-labels",
+                        help="Put each image file in a folder named after its shape, e.g. training/square/",
+                        action="store_true")
+    parser.add_argument("--archive",
+                        help="Stream the image files straight into archives in the dataset directory instead of "
+                             "saving them one by one. The archives come out the same every time for the same dataset",
+                        choices=["tar", "tar.gz", "zip"])
+    parser.add_argument("--archive-size",
+                        help="How many images go in each archive with --archive. 0 puts them all in one",
+                        type=int,
+                        default=0)
+    parser.add_argument("--archive-order",
+                        help="The order images go into the archives: plan for shape by shape, split for the "
+                             "training images then the validation images, shuffled for a random (seeded) order",
+                        default="plan",
+                        choices=["plan", "split", "shuffled"])
+    parser.add_argument("--writer-threads",
+                        help="Number of threads (per process) encoding and saving image files while the next images "
+                             "are rendered",
+                        type=positive_int,
+                        default=DEFAULT_WRITER_OPTIONS.threads)
+    parser.add_argument("--fsync",
+                        help="When to fsync image files: never, every --fsync-every files or after every file",
+                        default=DEFAULT_WRITER_OPTIONS.fsync,
+                        choices=["none", "batch", "always"])
+    parser.add_argument("--fsync-every",
+                        help="How many files each writer thread saves between fsyncs with --fsync batch",
+                        type=int,
+                        default=DEFAULT_WRITER_OPTIONS.fsync_every)
+    parser.add_argument("--png-compress-level",
+                        help="zlib compression level for png files, 0 (none, fastest) to 9 (smallest)",
+                        type=int,
+                        default=DEFAULT_WRITER_OPTIONS.png_compress_level,
+                        choices=range(0, 10))
+    parser.add_argument("--png-optimize",
+                        help="Have the png encoder look harder for a smaller file. Slow",
+                        action="store_true")
+    parser.add_argument("--palette",
+                        help="Save png files as palette (\"P\" mode) images. Every image only holds white and the four "
+                             "colors so nothing is lost, and the files are smaller and quicker to write. Not with "
+                             "--image-sizes",
+                        action="store_true")
+    parser.add_argument("--jpeg-quality",
+                        help="Quality of jpg files, 1 to 95",
+                        type=int,
+                        default=DEFAULT_WRITER_OPTIONS.jpeg_quality)
+    parser.add_argument("--jpeg-subsampling",
+                        help="Chroma subsampling of jpg files",
+                        default=DEFAULT_WRITER_OPTIONS.jpeg_subsampling,
+                        choices=["4:4:4", "4:2:2", "4:2:0"])
     parser.add_argument("--random-stats",
                         help="Script will generate sensible statistics for shapes at random. All shapes will be used."
                              " If this argument is set, the script will ignore any manual statistics that follow!",
@@ -367,11 +1966,65 @@ def run():
     parser.add_argument("--image-size",
                         help="Size (in pixels) of each image. Images are square so just enter one number",
                         type=int)
+    parser.add_argument("--image-sizes",
+                        help="Comma separated sizes, e.g. 64,128,256. Each image is rendered once at the largest size "
+                             "and shrunk to the others, and each size is saved in its own folder of the dataset. "
+                             "Overrides --image-size",
+                        type=size_list)
     parser.add_argument("--validation-split",
                         help="If set, this percentage of images will be put into the validation directory. "
                              "Value must be in range [0.0, 1.0]",
                         type=percentage_float,
                         default=0.0)
+    parser.add_argument("--seed",
+                        help="Seed for all of the random draws. The same seed always produces the same dataset. "
+                             "Chosen at random (and printed) if not given",
+                        type=int)
+    parser.add_argument("--workers",
+                        help="Number of processes to render images with. The output does not depend on this",
+                        type=int,
+                        default=1)
+    parser.add_argument("--renderer",
+                        help="How to draw the images. numpy is currently slower than pil for most shapes and sizes "
+                             "(see benchmark.py) and may differ from it by a few pixels along the edges of the shapes. "
+                             "It is mainly there for rendering batches straight into arrays",
+                        default="pil",
+                        choices=["pil", "numpy"])
+    parser.add_argument("--stripe-cache-mb",
+                        help="Memory budget (in MB, per process) for keeping rotated stripe images around. "
+                             "All 181 angles of all 4 colors take about 140MB at an image size of 256",
+                        type=int,
+                        default=256)
+    parser.add_argument("--prewarm-stripes",
+                        help="Rotate every stripe image before rendering starts, so workers share them instead of "
+                             "each rotating their own",
+                        action="store_true")
+    parser.add_argument("--num-shards",
+                        help="Split the dataset between this many machines. Each one runs with the same arguments "
+                             "(including --seed) and its own --shard-index, and merge_dataset.py puts the pieces "
+                             "back together",
+                        type=int,
+                        default=1)
+    parser.add_argument("--shard-index",
+                        help="Which piece of the dataset to make with --num-shards, from 0 to --num-shards - 1",
+                        type=int,
+                        default=0)
+    parser.add_argument("--resume",
+                        help="Carry on with a dataset that was interrupted, skipping the images its manifest says "
+                             "are saved. Everything but the output directory and dataset name comes from the manifest",
+                        action="store_true")
+    parser.add_argument("--extend",
+                        help="Add --square-number, --circle-number and --triangle-number more images to an existing "
+                             "dataset, with the statistics and seed in its manifest. Also finishes anything an "
+                             "interrupted run left undone",
+                        action="store_true")
+    parser.add_argument("--profile",
+                        help="Time each stage of making the images and print a summary at the end, along with how "
+                             "often each shape actually got its prototypical color and texture",
+                        action="store_true")
+    parser.add_argument("--stats-json",
+                        help="Write the full profile (per stage timing histograms, bytes written, images/sec over "
+                             "time, realized statistics) to this JSON file")
 
     square_group = parser.add_argument_group("Square Statistics")
     square_group.add_argument("--square-color",
@@ -430,52 +2083,155 @@ def run():
                                 help="The number of triangles we should generate as output",
                                 type=int)
 
-    args = parser.parse_args()
+    return parser
 
-    # Generate stats if user did not specify them
-    if args.random_stats:
-        args = random_stats(args)
 
-    # Convert the sets to lists to make things easier later
-    color_choices = list(color_choices)
-    texture_choices = list(texture_choices)
+def run(argv=None):
+    """
+    Parses the arguments and generates the image data
+    :param argv: List of command line arguments, sys.argv[1:] if None
+    """
+    generate(build_parser().parse_args(argv))
+
 
-    # Set up the directory structure
+def generate(args, pool=None):
+    """
+    Generates the dataset the arguments describe. Saves files as it goes to conserve RAM
+    If stats are not specified they will be generate
+    :param args: The namespace object returned by parse_args()
+    :param pool: Optional multiprocessing pool to render with, e.g. one shared by every dataset of a sweep. Its
+                 workers must have been set up with init_worker. --workers is ignored if given
+    :return: The dataset's manifest
+    """
+    color_choices = COLORS
     directory = os.path.join(args.output_directory, args.dataset_name)
-    traindir = os.path.join(directory, "training")
-    valdir = None
-    if args.validation_split > 0:
-        valdir = os.path.join(directory, "validation")
-    try:
-        os.makedirs(directory)
-        os.makedirs(traindir)
-        os.makedirs(valdir)
-    except OSError:
-        print("Unable to create directories")
-        exit(1)
-
-    # Create the stripe images twice the size so we can rotate them without issue
-    for color in color_choices:
-        STRIPES[color] = Image.new("RGB", (args.image_size * 2, args.image_size * 2), "white")
-        stripes = ImageDraw.Draw(STRIPES[color])
-        for y in xrange(0, args.image_size * 2, 20):
-            stripes.line([(0, y), (args.image_size * 2, y)], fill=color, width=3)
-        del stripes
 
-    # Make some squares
-    create_shape_set("square", args.filetype, args.square_number, args.square_color,
-                     args.square_percent_color, args.square_texture, args.square_percent_texture,
-                     color_choices, texture_choices, args.image_size, args.validation_split, traindir, valdir)
+    if args.resume or args.extend:
+        manifest = load_manifest(directory)
+        if manifest is None:
+            print("No {} in {} to resume from".format(MANIFEST_FILE, directory))
+            exit(1)
+        if args.extend:
+            extend_manifest(manifest, args)
+        args_from_manifest(args, manifest)
+    else:
+        if not 0 <= args.shard_index < args.num_shards:
+            print("--shard-index must be at least 0 and less than --num-shards")
+            exit(1)
+        if args.num_shards > 1 and args.seed is None:
+            print("--num-shards needs a --seed so every machine plans the same dataset")
+            exit(1)
+        if args.archive is not None and args.format != "files":
+            print("--archive only works with --format files")
+            exit(1)
+        if args.image_sizes is not None:
+            if args.format != "files" or args.archive is not None:
+                print("--image-sizes only works with --format files and without --archive")
+                exit(1)
+            # Shrinking blends the colors into the white around them, which a five color palette would throw away
+            if args.palette:
+                print("--palette does not work with --image-sizes, the smaller sizes have more than five colors")
+                exit(1)
+            # Render at the largest size and shrink from there
+            args.image_size = args.image_sizes[0]
+
+        if args.seed is None:
+            args.seed = random.SystemRandom().randint(0, 2 ** 32 - 1)
+            print("Using seed {}".format(args.seed))
+
+        # Generate stats if user did not specify them
+        if args.random_stats:
+            args = random_stats(args)
+
+        # Set up the directory structure
+        splits = []
+        if args.format == "files" and args.archive is None:
+            splits.append("training")
+        if args.format == "files" and args.archive is None and args.validation_split > 0:
+            splits.append("validation")
+        try:
+            os.makedirs(directory)
+            for root in dataset_roots(directory, args.image_sizes):
+                for split in splits:
+                    os.makedirs(os.path.join(root, split))
+                    if args.subfolder_labels:
+                        for shape in SHAPES:
+                            os.makedirs(os.path.join(root, split, shape))
+        except OSError:
+            print("Unable to create directories")
+            exit(1)
+        manifest = manifest_from_args(args)
+
+    stripe_cache_bytes = args.stripe_cache_mb * 1024 * 1024
+    profile = args.profile or args.stats_json is not None
+    init_worker(args.image_size, color_choices, stripe_cache_bytes, profile)
+    if args.prewarm_stripes:
+        STRIPE_CACHE.prewarm(color_choices, args.image_size)
+    own_pool = pool is None and args.workers > 1
+    if own_pool:
+        # Forked workers start with a copy of everything built so far, prewarmed stripes included
+        pool = multiprocessing.Pool(args.workers, init_worker,
+                                    (args.image_size, color_choices, stripe_cache_bytes, profile))
+
+    # Decide everything about every image up front
+    spec = spec_from_args(args)
+    tic = clock()
+    plan = plan_segments(spec.shapes, manifest["segments"], args.seed, spec.validation_split)
+    if PROFILER is not None:
+        PROFILER.add("plan", clock() - tic)
+
+    shards = None
+    archives = None
+    if args.archive is not None:
+        archives, batches = plan_archives(len(plan), args.archive, args.archive_size, manifest.get("archives", []),
+                                          manifest.get("archive_batches", []))
+        manifest["archives"] = archives
+        manifest["archive_batches"] = batches
+        plan = plan[archive_order(plan, batches, args.archive_order, args.seed)]
+    if args.format == "npy-shards":
+        shards = create_shards(plan, args.image_size, directory, args.shard_size, manifest.get("shards", []),
+                               args.shard_index, args.num_shards)
+        manifest["shards"] = shards
+    if args.resume or args.extend:
+        units = work_units(len(plan), shards or archives)[args.shard_index::args.num_shards]
+        total = sum(stop - start for _, start, stop in units)
+        pending = sum(todo_stop - todo_start for _, start, stop in units
+                      for todo_start, todo_stop in pending_ranges(start, stop, manifest["completed"]))
+        print("{} of {} images already saved".format(total - pending, total))
+    widths = segment_widths(manifest["widths"], manifest["segments"])
+    if args.format == "files":
+        for root, size in zip(dataset_roots(directory, args.image_sizes), args.image_sizes or [args.image_size]):
+            write_label_index(plan, widths, args.filetype, size, root, args.subfolder_labels, archives,
+                              args.image_size)
+    sync = args.fsync != "none"
+    save_manifest(directory, manifest, sync)
+
+    def checkpoint(start, stop):
+        # Only called once the images are saved, so a crash never marks anything done that is not
+        manifest["completed"] = add_range(manifest["completed"], start, stop)
+        save_manifest(directory, manifest, sync)
+
+    # Make some squares, circles and triangles
+    create_images(plan, widths, args.filetype, args.image_size, directory, pool, args.renderer,
+                  args.format, args.shard_size, writer_options_from_args(args), shards, manifest["completed"],
+                  checkpoint, args.shard_index, args.num_shards, args.archive, archives, args.subfolder_labels,
+                  args.image_sizes)
 
-    # Make some circles
-    create_shape_set("circle", args.filetype, args.circle_number, args.circle_color,
-                     args.circle_percent_color, args.circle_texture, args.circle_percent_texture,
-                     color_choices, texture_choices, args.image_size, args.validation_split, traindir, valdir)
+    if own_pool:
+        pool.close()
+        pool.join()
 
-    # Make some triangles
-    create_shape_set("triangle", args.filetype, args.triangle_number, args.triangle_color,
-                     args.triangle_percent_color, args.triangle_texture, args.triangle_percent_texture,
-                     color_choices, texture_choices, args.image_size, args.validation_split, traindir, valdir)
+    if PROFILER is not None:
+        PROFILER.merge(take_profile())
+        report = PROFILER.report()
+        report["seed"] = args.seed
+        report["statistics"] = realized_statistics(spec, plan)
+        if args.profile:
+            print_report(report)
+        if args.stats_json is not None:
+            with open(args.stats_json, "w") as fp:
+                json.dump(report, fp, indent=2, sort_keys=True)
+    return manifest
 
 
 if __name__ == "__main__":
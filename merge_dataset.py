@@ -0,0 +1,140 @@
+import argparse
+import json
+import os
+import shutil
+import generate_dataset
+
+
+def check_manifests(directories, manifests):
+    """
+    Makes sure a set of directories hold every piece of one dataset made with --num-shards, each of them finished
+    :param directories: The dataset directory made by each machine
+    :param manifests: Their manifests, loaded with generate_dataset.load_manifest
+    :return: List of problems, empty if they fit together
+    """
+    problems = []
+    for directory, manifest in zip(directories, manifests):
+        if manifest is None:
+            problems.append("{} has no {}".format(directory, generate_dataset.MANIFEST_FILE))
+    if problems:
+        return problems
+
+    first = manifests[0]
+    indices = sorted(manifest["shard_index"] for manifest in manifests)
+    if indices != list(range(first["num_shards"])):
+        problems.append("expected one directory for each --shard-index from 0 to {}, got {}".format(
+            first["num_shards"] - 1, indices))
+    for directory, manifest in zip(directories, manifests):
+        # Everything but which piece it is and how far it got has to match, or they are not the same dataset
+        for key in sorted(set(first) | set(manifest)):
+            if key not in ("shard_index", "completed") and manifest.get(key) != first.get(key):
+                problems.append("{} has a different {} than {}".format(directory, key, directories[0]))
+    if problems:
+        return problems
+
+    for directory, manifest in zip(directories, manifests):
+        if not generate_dataset.manifest_finished(manifest):
+            problems.append("{} is not finished, carry on with --resume".format(directory))
+    return problems
+
+
+def merge(directories, destination, copy=False):
+    """
+    Puts the pieces of a dataset made with --num-shards back together into one dataset directory, the same as if
+    it had been made on one machine
+    :param directories: The dataset directory made by each machine, in any order
+    :param destination: The dataset directory to make. Must not exist yet
+    :param copy: Copy the images instead of moving them
+    """
+    manifests = [generate_dataset.load_manifest(directory) for directory in directories]
+    problems = check_manifests(directories, manifests)
+    for problem in problems:
+        print(problem)
+    if problems:
+        exit(1)
+
+    # Put them in --shard-index order
+    by_index = dict((manifest["shard_index"], directory) for directory, manifest in zip(directories, manifests))
+    directories = [by_index[index] for index in sorted(by_index)]
+    manifest = manifests[0]
+    transfer = shutil.copy2 if copy else shutil.move
+
+    try:
+        os.makedirs(destination)
+    except OSError:
+        print("Unable to create directories")
+        exit(1)
+
+    # Relative to the dataset directory, one per size with --image-sizes
+    roots = [os.path.relpath(root, directories[0])
+             for root in generate_dataset.dataset_roots(directories[0], manifest.get("image_sizes"))]
+    if manifest["format"] == "files":
+        # Every machine writes the label index of the whole dataset
+        for root in roots:
+            if not os.path.isdir(os.path.join(destination, root)):
+                os.makedirs(os.path.join(destination, root))
+            for name in ["labels.csv", "labels.npz"]:
+                shutil.copy2(os.path.join(directories[0], root, name), os.path.join(destination, root, name))
+
+    if manifest.get("archive") is not None:
+        # Archives are dealt out round robin like npy shards
+        for index, (name, _, _) in enumerate(manifest["archives"]):
+            transfer(os.path.join(directories[index % len(directories)], name), os.path.join(destination, name))
+    elif manifest["format"] == "npy-shards":
+        # The labels cover the whole dataset on every machine, the image shards are dealt out round robin
+        with open(os.path.join(directories[0], "shards.json")) as fp:
+            names = ["shards.json"] + json.load(fp)["labels"]
+        for name in names:
+            shutil.copy2(os.path.join(directories[0], name), os.path.join(destination, name))
+        for index, (name, _, _) in enumerate(manifest["shards"]):
+            transfer(os.path.join(directories[index % len(directories)], name), os.path.join(destination, name))
+    else:
+        for split in [os.path.join(root, split) for root in roots for split in generate_dataset.SPLITS]:
+            if not os.path.isdir(os.path.join(directories[0], split)):
+                continue
+            for directory in directories:
+                # With --subfolder-labels the images are a folder further down
+                for folder, _, names in os.walk(os.path.join(directory, split)):
+                    target = os.path.join(destination, os.path.relpath(folder, directory))
+                    if not os.path.isdir(target):
+                        os.makedirs(target)
+                    for name in sorted(names):
+                        transfer(os.path.join(folder, name), os.path.join(target, name))
+
+    completed = []
+    for other in manifests:
+        for start, stop in other["completed"]:
+            completed = generate_dataset.add_range(completed, start, stop)
+    merged = dict(manifest)
+    merged["shard_index"] = 0
+    merged["num_shards"] = 1
+    merged["completed"] = completed
+    generate_dataset.save_manifest(destination, merged)
+
+
+def run():
+    """
+    Parses the arguments and merges the dataset
+    """
+    parser = argparse.ArgumentParser(prog="merge_dataset.py",
+                                     description="Combines the pieces of a dataset made on several machines with "
+                                                 "generate_dataset.py --num-shards into one dataset, identical to "
+                                                 "one made on a single machine.")
+    parser.add_argument("directories",
+                        help="The dataset directory made by each machine (output directory/dataset name)",
+                        nargs="+")
+    parser.add_argument("--output-directory",
+                        help="The directory to save the merged dataset to.",
+                        required=True)
+    parser.add_argument("--dataset-name",
+                        help="Name of the merged dataset. Will be the name of the final output directory.",
+                        required=True)
+    parser.add_argument("--copy",
+                        help="Copy the images instead of moving them out of the pieces",
+                        action="store_true")
+    args = parser.parse_args()
+    merge(args.directories, os.path.join(args.output_directory, args.dataset_name), args.copy)
+
+
+if __name__ == "__main__":
+    run()
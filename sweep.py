@@ -0,0 +1,175 @@
+import argparse
+import itertools
+import multiprocessing
+import os
+import random
+import time
+import generate_dataset
+
+
+# Where the combined manifest goes, in the output directory
+SWEEP_FILE = "sweep.json"
+
+
+def grid_configs(base, grid):
+    """
+    Every combination of the values of the grid, on top of the base arguments
+    :param base: List of arguments every dataset shares, e.g. ["@args.txt"]
+    :param grid: List of "option=value,value,..." strings, e.g. "square-percent-color=0.6,0.8"
+    :return: List of (argument list, dict of the grid values it uses), one per dataset
+    """
+    options = []
+    for entry in grid:
+        option, _, values = entry.partition("=")
+        options.append([(option.lstrip("-"), value) for value in values.split(",")])
+    configs = []
+    for combination in itertools.product(*options):
+        argv = list(base)
+        for option, value in combination:
+            argv += ["--" + option, value]
+        configs.append((argv, dict(combination)))
+    return configs
+
+
+def sweep_args(argv, name, index, output_directory, seed):
+    """
+    Parses the arguments of one dataset of the sweep
+    :param argv: Its argument list
+    :param name: Dataset name of the sweep, None to keep the one in the arguments
+    :param index: Its number in the sweep, added to the name
+    :param output_directory: Where to save it, None to keep the one in the arguments
+    :param seed: Seed to use if the arguments have none
+    :return: The namespace object from parse_args()
+    """
+    args = generate_dataset.build_parser().parse_args(argv)
+    if name is not None:
+        args.dataset_name = "{}_{:03d}".format(name, index)
+    if output_directory is not None:
+        args.output_directory = output_directory
+    if args.seed is None:
+        args.seed = seed
+    return args
+
+
+def run():
+    """
+    Parses the arguments, works out every dataset of the sweep and generates them one after another in one pool
+    """
+    parser = argparse.ArgumentParser(prog="sweep.py",
+                                     description="Generates many datasets in one process, sharing one pool of workers "
+                                                 "(and their stripe and template caches) between them. The datasets "
+                                                 "come from a list of argfiles, a grid of values on top of a base "
+                                                 "argfile, or random statistics on top of a base argfile. Writes "
+                                                 "sweep.json listing every dataset and its statistics.",
+                                     fromfile_prefix_chars="@")
+    parser.add_argument("--argfiles",
+                        help="Generate one dataset per argfile, each with its own --dataset-name",
+                        nargs="+")
+    parser.add_argument("--base",
+                        help="Argfile every dataset of --grid or --random starts from")
+    parser.add_argument("--grid",
+                        help="Option and comma separated values to sweep over, e.g. "
+                             "square-percent-color=0.6,0.7,0.8. Give it more than once for every combination",
+                        action="append")
+    parser.add_argument("--random",
+                        help="Generate this many datasets with --random-stats, each with its own seed",
+                        type=int)
+    parser.add_argument("--output-directory",
+                        help="Where to save every dataset. Defaults to the --output-directory of each argfile")
+    parser.add_argument("--dataset-name",
+                        help="Name for the datasets of --grid or --random, numbered _000, _001, ... Defaults to "
+                             "the --dataset-name of the base argfile")
+    parser.add_argument("--seed",
+                        help="Seed for any dataset that does not set its own. Chosen at random (and printed) if not "
+                             "given. --random adds the number of the dataset to it",
+                        type=int)
+    parser.add_argument("--workers",
+                        help="Number of processes to render every dataset with",
+                        type=int,
+                        default=multiprocessing.cpu_count())
+    parser.add_argument("--stripe-cache-mb",
+                        help="Memory budget (in MB, per process) for rotated stripe images, shared by every dataset",
+                        type=int,
+                        default=256)
+    parser.add_argument("--resume",
+                        help="Skip the datasets that are finished and carry on with any that were interrupted",
+                        action="store_true")
+    args = parser.parse_args()
+
+    if sum([args.argfiles is not None, args.grid is not None, args.random is not None]) != 1:
+        parser.error("give exactly one of --argfiles, --grid or --random")
+    if args.argfiles is None and args.base is None:
+        parser.error("--grid and --random need a --base argfile")
+    if args.seed is None:
+        args.seed = random.SystemRandom().randint(0, 2 ** 32 - 1)
+        print("Using seed {}".format(args.seed))
+
+    if args.argfiles is not None:
+        configs = [sweep_args(["@" + argfile], None, index, args.output_directory, args.seed)
+                   for index, argfile in enumerate(args.argfiles)]
+        values = [{"argfile": argfile} for argfile in args.argfiles]
+    else:
+        base = generate_dataset.build_parser().parse_args(["@" + args.base])
+        name = args.dataset_name or base.dataset_name
+        if args.grid is not None:
+            grid = grid_configs(["@" + args.base], args.grid)
+            configs = [sweep_args(argv, name, index, args.output_directory, args.seed)
+                       for index, (argv, _) in enumerate(grid)]
+            values = [combination for _, combination in grid]
+        else:
+            configs = [sweep_args(["@" + args.base, "--random-stats", "--seed", str(args.seed + index)], name, index,
+                                  args.output_directory, None)
+                       for index in range(args.random)]
+            values = [{} for _ in configs]
+
+    directories = [os.path.join(config.output_directory, config.dataset_name) for config in configs]
+    if len(set(directories)) != len(directories):
+        parser.error("every dataset of the sweep needs its own output directory or dataset name")
+    output_directory = os.path.dirname(directories[0])
+    if not os.path.isdir(output_directory):
+        os.makedirs(output_directory)
+
+    # One pool for everything. Workers build the stripes and templates of each image size the first time they
+    # see it and keep them for every dataset after
+    stripe_cache_bytes = args.stripe_cache_mb * 1024 * 1024
+    pool = None
+    if args.workers > 1:
+        pool = multiprocessing.Pool(args.workers, generate_dataset.init_worker,
+                                    (configs[0].image_size or configs[0].image_sizes[0], generate_dataset.COLORS,
+                                     stripe_cache_bytes))
+
+    path = os.path.join(output_directory, SWEEP_FILE)
+    sweep = {"seed": args.seed, "workers": args.workers, "datasets": []}
+    try:
+        for config, directory, value in zip(configs, directories, values):
+            manifest = generate_dataset.load_manifest(directory)
+            finished = False
+            if args.resume and manifest is not None:
+                finished = generate_dataset.manifest_finished(manifest)
+                config.resume = not finished
+            if finished:
+                print("{} is finished".format(directory))
+                seconds = None
+            else:
+                print("Generating {}".format(directory))
+                config.stripe_cache_mb = args.stripe_cache_mb
+                tic = time.time()
+                manifest = generate_dataset.generate(config, pool)
+                seconds = time.time() - tic
+            sweep["datasets"].append({"directory": directory,
+                                      "values": value,
+                                      "seed": manifest["seed"],
+                                      "image_size": manifest["image_size"],
+                                      "images": sum(stop - start for _, start, stop in manifest["segments"]),
+                                      "shapes": manifest["shapes"],
+                                      "seconds": seconds})
+            # Saved after every dataset, so it always says what is done
+            generate_dataset.save_json(path, sweep)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+
+if __name__ == "__main__":
+    run()
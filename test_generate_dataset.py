@@ -0,0 +1,29 @@
+import pytest
+import generate_dataset
+
+
+# Images of each shape compared at each size, with every color and texture mixed in
+PARITY_IMAGES = 300
+
+# Most of the pixels of any one image the two renderers may disagree on. They only differ where antialiasing
+# and rounding land a pixel on the other side of a shape's edge
+PARITY_TOLERANCE = 0.01
+
+
+@pytest.mark.parametrize("image_size", [64, 256])
+@pytest.mark.parametrize("shape", generate_dataset.SHAPES)
+def test_numpy_renderer_matches_pil(shape, image_size):
+    generate_dataset.init_worker(image_size, generate_dataset.COLORS)
+    # Percents of 0 leave every color and texture to chance
+    plan = generate_dataset.plan_shape_set(shape, 0, PARITY_IMAGES, "red", 0.0, "striped", 0.0, 1)
+    assert set(plan["texture"]) == set(range(len(generate_dataset.TEXTURES)))
+
+    pil = generate_dataset.render_array(plan, image_size, "pil")
+    vectorized = generate_dataset.render_array(plan, image_size, "numpy")
+    assert vectorized.shape == pil.shape
+
+    mismatched = (pil != vectorized).any(axis=3).mean(axis=(1, 2))
+    worst = mismatched.argmax()
+    assert mismatched[worst] < PARITY_TOLERANCE, "image {} ({} {}) differs in {:.2%} of its pixels".format(
+        worst, generate_dataset.COLORS[plan["color"][worst]], generate_dataset.TEXTURES[plan["texture"][worst]],
+        mismatched[worst])
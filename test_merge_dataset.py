@@ -0,0 +1,31 @@
+import pytest
+import generate_dataset
+import merge_dataset
+
+
+def piece_manifests(*extra):
+    """
+    :param extra: Arguments every piece adds, on top of the same dataset
+    :return: Finished manifests of both pieces of a dataset made with --num-shards 2
+    """
+    manifests = []
+    for shard_index in range(2):
+        args = generate_dataset.build_parser().parse_args(
+            ["--image-size", "32", "--seed", "1", "--num-shards", "2", "--shard-index", str(shard_index),
+             "--square-number", "100", "--circle-number", "0", "--triangle-number", "0"] + list(extra[shard_index]))
+        manifest = generate_dataset.manifest_from_args(args)
+        manifest["completed"] = [[0, 100]]
+        manifests.append(manifest)
+    return manifests
+
+
+def test_matching_pieces_merge():
+    assert merge_dataset.check_manifests(["a", "b"], piece_manifests([], [])) == []
+
+
+@pytest.mark.parametrize("extra", [["--jpeg-quality", "95"], ["--jpeg-subsampling", "4:4:4"], ["--palette"],
+                                   ["--png-compress-level", "9"], ["--png-optimize"]])
+def test_different_encoder_settings_are_rejected(extra):
+    problems = merge_dataset.check_manifests(["a", "b"], piece_manifests([], extra))
+    assert len(problems) == 1
+    assert problems[0].startswith("b has a different {} than a".format(extra[0].lstrip("-").replace("-", "_")))